@@ -0,0 +1,295 @@
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import resource
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+# Benchmarks register a setup function that receives the parsed arguments and returns the step to time
+benchmarks = {}
+
+
+def benchmark(name):
+    def register(setup):
+        benchmarks[name] = setup
+        return setup
+    return register
+
+
+def parse_arguments():
+    argument_parser = argparse.ArgumentParser(description="Time the pre training, inner update, data and evaluation "
+                                                          "steps on synthetic inputs")
+    argument_parser.add_argument("--benchmarks", nargs="+", choices=sorted(benchmarks), default=sorted(benchmarks),
+                                 help="Benchmarks to run, each one in a separate process")
+    argument_parser.add_argument("--steps", type=int, default=20,
+                                 help="Number of timed steps of every benchmark")
+    argument_parser.add_argument("--warmup", type=int, default=2,
+                                 help="Number of untimed steps before the timed ones, e.g. tracing of tf.functions")
+    argument_parser.add_argument("--seed", type=int, default=0,
+                                 help="Seed of the synthetic inputs")
+    argument_parser.add_argument("--output", type=str, default=None,
+                                 help="JSON file of the results, printed if not given")
+    argument_parser.add_argument("--compare", type=str, default=None,
+                                 help="JSON results of a previous run, e.g. of another commit, to compare against")
+    argument_parser.add_argument("--compiled", action='store_true',
+                                 help="Run the ISW meta-updates as a single compiled graph")
+    argument_parser.add_argument("--fast_weights", action='store_true',
+                                 help="Run the meta-updates on fast weights")
+    argument_parser.add_argument("--xla", action='store_true',
+                                 help="Compile the Omniglot fast weights meta-update with XLA")
+    argument_parser.add_argument("--mixed_precision", action='store_true',
+                                 help="Compute the Omniglot models in bfloat16")
+    argument_parser.add_argument("--sparse", action='store_true',
+                                 help="Omniglot online training on the nonzero elements of sparse representations")
+    argument_parser.add_argument("--sparsity", type=float, default=0.9,
+                                 help="Fraction of zero elements of the synthetic representations of the Omniglot "
+                                      "online training runs")
+    argument_parser.add_argument("--omniglot_classes", type=int, default=964,
+                                 help="Number of classes of the synthetic Omniglot background set")
+    argument_parser.add_argument("--evaluation_classes", type=int, default=50,
+                                 help="Number of classes of an Omniglot evaluation episode")
+    return argument_parser.parse_args()
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10
+
+
+def time_steps(step, steps, warmup):
+    """
+    :param step: Function without arguments, its result is materialized so that asynchronous work is timed too
+    :return: Throughput, latency percentiles in milliseconds and peak RSS of the process
+    :rtype: dict
+    """
+    start = time.perf_counter()
+    materialize(step())
+    first_step = time.perf_counter() - start
+    for _ in range(warmup - 1):
+        materialize(step())
+
+    latencies = []
+    for _ in range(steps):
+        start = time.perf_counter()
+        materialize(step())
+        latencies.append(time.perf_counter() - start)
+    latencies = np.array(latencies)
+    return {"steps": steps,
+            "steps_per_second": float(steps / latencies.sum()),
+            "first_step_ms": 1000 * first_step,
+            "latency_ms": {"mean": float(1000 * latencies.mean()),
+                           **{f"p{p}": float(1000 * np.percentile(latencies, p)) for p in (50, 90, 99)}},
+            "peak_rss_mb": peak_rss_mb()}
+
+
+def materialize(result):
+    import tensorflow as tf
+    for t in tf.nest.flatten(result):
+        if isinstance(t, tf.Tensor):
+            t.numpy()
+
+
+@benchmark("gen_sine_data")
+def gen_sine_data_setup(args):
+    from datasets.synth_datasets import gen_tasks, gen_sine_data
+    rng = np.random.default_rng(args.seed)
+    tasks = gen_tasks(400, rng=rng)
+    return lambda: gen_sine_data(tasks, n_functions=10, sample_length=32, repetitions=40, rng=rng)
+
+
+def isw_models(args):
+    import tensorflow as tf
+    from datasets.synth_datasets import gen_tasks
+    from experiments.exp4_2.isw import mrcl_isw
+    from experiments.training import prepare_data_pre_training
+    rng = np.random.default_rng(args.seed)
+    rln, tln = mrcl_isw(one_hot_depth=10, representation_size=900)
+    episode = prepare_data_pre_training(gen_tasks(400, rng=rng), 10, 32, 40, rng=rng)
+    return rln, tln, tf.keras.models.clone_model(tln), episode
+
+
+@benchmark("pretrain_mrcl")
+def pretrain_mrcl_setup(args):
+    import tensorflow as tf
+    from experiments.training import pretrain_mrcl
+    rln, tln, tln_copy, (x_traj, y_traj, x_rand, y_rand) = isw_models(args)
+    meta_optimizer = tf.keras.optimizers.Adam(learning_rate=1e-4)
+    loss_function = tf.keras.losses.MeanSquaredError()
+    return lambda: pretrain_mrcl(x_traj=x_traj, y_traj=y_traj, x_rand=x_rand, y_rand=y_rand, rln=rln, tln=tln,
+                                 tln_initial=tln_copy, meta_optimizer=meta_optimizer, loss_function=loss_function,
+                                 beta=3e-3, compiled=args.compiled, fast_weights=args.fast_weights)
+
+
+@benchmark("inner_update_isw")
+def inner_update_isw_setup(args):
+    import tensorflow as tf
+    from experiments.training import inner_update
+    rln, tln, _, (x_traj, y_traj, _, _) = isw_models(args)
+    loss_function = tf.keras.losses.MeanSquaredError()
+    return lambda: inner_update(x=x_traj[0], y=y_traj[0], tln=tln, rln=rln, beta=3e-3, loss_fun=loss_function)
+
+
+@benchmark("evaluate_models_isw")
+def evaluate_models_isw_setup(args):
+    from datasets.synth_datasets import gen_tasks
+    from experiments.exp4_2.isw import mrcl_isw
+    from experiments.evaluation import evaluate_models_isw, prepare_data_evaluation
+    np.random.seed(args.seed)
+    rln, tln = mrcl_isw(one_hot_depth=10, representation_size=900)
+    x_train, y_train, x_val, y_val = prepare_data_evaluation(gen_tasks(500), 10, 32, 50, seed=args.seed)
+    return lambda: evaluate_models_isw(x_train=x_train, y_train=y_train, x_val=x_val, y_val=y_val, tln=tln, rln=rln,
+                                       learning_rate=3e-3)
+
+
+def omniglot_arrays(args):
+    """
+    Random images and labels in the layout of load_omniglot_arrays
+    """
+    rng = np.random.default_rng(args.seed)
+    images = rng.integers(0, 256, (args.omniglot_classes * 20, 84, 84, 1), dtype=np.uint8)
+    labels = np.repeat(np.arange(args.omniglot_classes, dtype=np.int64), 20)
+    return images, labels
+
+
+def omniglot_models(args, classes=964):
+    from experiments.exp4_2.omniglot_model import mrcl_omniglot
+    from experiments.training import dtype_policy
+    # Clones of the models, e.g. the initial TLN, keep their policy
+    with dtype_policy("mixed_bfloat16" if args.mixed_precision else None):
+        return mrcl_omniglot(classes=classes)
+
+
+@benchmark("get_background_data_by_classes")
+def get_background_data_by_classes_setup(args):
+    from experiments.exp4_2.omniglot_model import get_background_data_by_classes
+    data = omniglot_arrays(args)
+    return lambda: get_background_data_by_classes(data)
+
+
+def omniglot_pretraining_samples(args):
+    from experiments.exp4_2.omniglot_model import get_background_data_by_classes, partition_into_disjoint, \
+        sample_trajectory, sample_random_10_classes
+    np.random.seed(args.seed)
+    background_training_data, _, _ = get_background_data_by_classes(omniglot_arrays(args))
+    s_learn, s_remember = partition_into_disjoint(background_training_data)
+    x_rand, y_rand = sample_random_10_classes(s_remember, background_training_data)
+    x_traj, y_traj = sample_trajectory(s_learn, background_training_data)
+    return x_traj, y_traj, x_rand, y_rand
+
+
+@benchmark("pretrain_classification_mrcl")
+def pretrain_classification_mrcl_setup(args):
+    import tensorflow as tf
+    from experiments.exp4_2.omniglot_model import pretrain_classification_mrcl
+    from parameters import classification_parameters
+    x_traj, y_traj, x_rand, y_rand = omniglot_pretraining_samples(args)
+    rln, tln = omniglot_models(args)
+    tln_initial = None if args.fast_weights else tf.keras.models.clone_model(tln)
+    return lambda: pretrain_classification_mrcl(x_traj, y_traj, x_rand, y_rand, rln, tln, tln_initial,
+                                                classification_parameters, fast_weights=args.fast_weights,
+                                                jit_compile=args.xla)
+
+
+@benchmark("inner_update_omniglot")
+def inner_update_omniglot_setup(args):
+    from experiments.exp4_2.omniglot_model import inner_update
+    from parameters import classification_parameters
+    x_traj, y_traj, _, _ = omniglot_pretraining_samples(args)
+    rln, tln = omniglot_models(args)
+    return lambda: inner_update(x_traj[0], y_traj[0], rln, tln, classification_parameters)
+
+
+@benchmark("evaluate_classification_mrcl")
+def evaluate_classification_mrcl_setup(args):
+    from experiments.exp4_2.omniglot_model import get_background_data_by_classes, evaluate_classification_mrcl
+    from parameters import classification_parameters
+    np.random.seed(args.seed)
+    _, training_data, testing_data = get_background_data_by_classes(omniglot_arrays(args))
+    rln, tln = omniglot_models(args, classes=args.evaluation_classes)
+    return lambda: evaluate_classification_mrcl(training_data, testing_data, rln, tln, args.evaluation_classes,
+                                                classification_parameters, sparse=args.sparse)
+
+
+@benchmark("evaluate_classification_mrcl_runs")
+def evaluate_classification_mrcl_runs_setup(args):
+    from experiments.exp4_2.omniglot_model import ClassIndexedData, evaluate_classification_mrcl_runs, \
+        initial_tln_weights
+    from experiments.training import compacted_size
+    from parameters import classification_parameters
+    np.random.seed(args.seed)
+    # Random representations in the layout of the flattened RLN output of every class, with the given sparsity
+    representations = np.random.rand(args.evaluation_classes, 20, 2304).astype(np.float32)
+    representations[np.random.rand(*representations.shape) < args.sparsity] = 0
+    labels = np.repeat(np.arange(args.evaluation_classes)[:, None], 20, axis=1)
+    training_data = ClassIndexedData(representations[:, :15], labels[:, :15])
+    testing_data = ClassIndexedData(representations[:, 15:], labels[:, 15:])
+    _, tln = omniglot_models(args, classes=args.evaluation_classes)
+    learning_rates = [0.3, 0.1, 0.03, 0.01, 0.003, 0.001, 0.0003, 0.0001, 0.00003, 0.00001]
+    tln_weights = [initial_tln_weights(tln) for _ in learning_rates]
+    # A single compacted size for all the episodes, like OmniglotEvaluator
+    sparse_size = compacted_size(training_data.images, round_up=False) if args.sparse else None
+    return lambda: evaluate_classification_mrcl_runs(training_data, testing_data, None, tln, tln_weights,
+                                                     args.evaluation_classes, learning_rates,
+                                                     classification_parameters, sparse=sparse_size is not None,
+                                                     sparse_size=sparse_size)
+
+
+def run_benchmark(name, args):
+    return time_steps(benchmarks[name](args), args.steps, args.warmup)
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline):
+    """
+    Print the speedup of every benchmark over the baseline results
+    """
+    for name, result in results["benchmarks"].items():
+        if name not in baseline["benchmarks"]:
+            continue
+        previous = baseline["benchmarks"][name]
+        print(f"{name}: {result['steps_per_second'] / previous['steps_per_second']:.2f}x steps/s, "
+              f"p50 {previous['latency_ms']['p50']:.1f} -> {result['latency_ms']['p50']:.1f} ms, "
+              f"peak RSS {previous['peak_rss_mb']:.0f} -> {result['peak_rss_mb']:.0f} MB")
+
+
+def main(args):
+    results = {"commit": git_commit(),
+               "time": datetime.datetime.now().isoformat(),
+               "arguments": {k: v for k, v in vars(args).items() if k not in ("output", "compare")},
+               "benchmarks": {}}
+
+    # A fresh process per benchmark isolates its peak RSS and its traced graphs from the others
+    context = multiprocessing.get_context("spawn")
+    for name in args.benchmarks:
+        with context.Pool(1) as pool:
+            results["benchmarks"][name] = pool.apply(run_benchmark, (name, args))
+        print(f"{name}: {results['benchmarks'][name]['steps_per_second']:.2f} steps/s", file=sys.stderr)
+
+    if args.output is None:
+        print(json.dumps(results, indent=2))
+    else:
+        if os.path.dirname(args.output):
+            os.makedirs(os.path.dirname(args.output), exist_ok=True)
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main(parse_arguments())
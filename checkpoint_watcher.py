@@ -0,0 +1,108 @@
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from experiments.training import WeightCheckpoints
+from util.results_store import ResultsStore
+
+scripts_dir = os.path.dirname(os.path.abspath(__file__))
+
+
+def parse_args():
+    argument_parser = argparse.ArgumentParser(
+        description="Evaluate the weight checkpoints of a pretraining as they appear. Arguments that are not listed "
+                    "here are passed on to the evaluation script, e.g. --tests 10 to isw_evaluation.py")
+    argument_parser.add_argument("name", type=str,
+                                 help="Name of the checkpoints, e.g. isw_mrcl for saved_models/isw_mrcl_100.npz")
+    argument_parser.add_argument("--dataset", choices=["isw", "omniglot"], default="isw",
+                                 help="Evaluation protocol, isw_evaluation.py or omniglot_mrcl_evaluation.py")
+    argument_parser.add_argument("--directory", default="saved_models", type=str,
+                                 help="Directory of the checkpoints")
+    argument_parser.add_argument("--results_db", default="results/results.db", type=str,
+                                 help="Results store of the evaluations and the learning curve")
+    argument_parser.add_argument("--poll_interval", default=60, type=float,
+                                 help="Seconds between looks for new checkpoints")
+    argument_parser.add_argument("--until_epoch", default=None, type=int,
+                                 help="Stop after evaluating a checkpoint of this epoch or a later one")
+    argument_parser.add_argument("--once", action='store_true',
+                                 help="Evaluate the checkpoints already written and stop")
+    return argument_parser.parse_known_args()
+
+
+def evaluation_command(args, path, epoch, evaluation_args):
+    if args.dataset == "isw":
+        return [sys.executable, os.path.join(scripts_dir, "isw_evaluation.py"), f"{args.name}_{epoch}",
+                "--model_file_rln", f"{path}:rln", "--model_file_tln", f"{path}:tln",
+                "--results_db", args.results_db] + evaluation_args
+    # The Omniglot evaluation finds the checkpoint by its path relative to saved_models
+    return [sys.executable, os.path.join(scripts_dir, "omniglot_mrcl_evaluation.py"),
+            os.path.relpath(path, "saved_models"), "--results_db", args.results_db] + evaluation_args
+
+
+def learning_curve_point(args, store, path, epoch):
+    """
+    Summary of the stored results of the evaluation of a checkpoint
+    :return: Mean loss over the trials for ISW, mean test accuracy over the runs of every number of classes for
+             Omniglot
+    :rtype: dict
+    """
+    if args.dataset == "isw":
+        # Only the trials of the chosen learning rate that the evaluation ran, the store can also hold trials of
+        # evaluations with other learning rates or numbers of tests
+        model = f"{args.name}_{epoch}"
+        evaluation, = [result["value"] for result in store.load(model=model, dataset="isw", metric="evaluation")]
+        losses = {result["seed"]: result["value"] for result in
+                  store.load(model=model, dataset="isw", learning_rate=evaluation["learning_rate"], metric="loss")}
+        return {"loss": float(np.mean([losses[seed] for seed in evaluation["seeds"]]))}
+    accuracies = {}
+    for result in store.load(model=f"mrcl/{os.path.relpath(path, 'saved_models')}", dataset="omniglot",
+                             metric="test_accuracy"):
+        accuracies.setdefault(str(result["classes"]), []).append(result["value"])
+    return {classes: float(np.mean(values)) for classes, values in accuracies.items()}
+
+
+def main(args, evaluation_args):
+    checkpoints = WeightCheckpoints(args.name, directory=args.directory)
+    store = ResultsStore(args.results_db)
+    summary_writer = tf.summary.create_file_writer(os.path.join("logs", "checkpoint_evaluation", args.name))
+
+    # The learning curve is stored with the epoch of every checkpoint in place of the seed, and also tells which
+    # checkpoints were already evaluated by a previous watcher
+    def evaluated_epochs():
+        return {result["seed"] for result in store.load(model=args.name, dataset=args.dataset, metric="curve")}
+
+    while True:
+        for epoch in sorted(set(checkpoints.epochs()) - evaluated_epochs()):
+            path = checkpoints.path(epoch)
+            print(f"Evaluating {path}")
+            if subprocess.run(evaluation_command(args, path, epoch, evaluation_args)).returncode != 0:
+                if not os.path.exists(path):
+                    # Removed by the pretraining, which keeps only the most recent checkpoints
+                    print(f"Skipped {path}, it was removed during its evaluation")
+                    continue
+                raise RuntimeError(f"Evaluation of {path} failed")
+
+            point = learning_curve_point(args, store, path, epoch)
+            store.append(args.name, args.dataset, 0, 0.0, epoch, curve=point)
+            with summary_writer.as_default():
+                for name, value in point.items():
+                    tf.summary.scalar(f"Checkpoint evaluation/{name}", value, step=epoch)
+            print(f"Epoch {epoch}: {point}")
+
+            if args.until_epoch is not None and epoch >= args.until_epoch:
+                store.close()
+                return
+
+        if args.once:
+            break
+        time.sleep(args.poll_interval)
+    store.close()
+
+
+if __name__ == '__main__':
+    main(*parse_args())
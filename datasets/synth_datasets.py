@@ -2,7 +2,6 @@
 
 import numpy as np
 from math import pi
-import random
 
 # Constant Sine values as defined in section 4.1
 amp_min = 0.1
@@ -13,23 +12,26 @@ z_min = -5
 z_max = 5
 
 
-def gen_tasks(number_of_tasks):
+def gen_tasks(number_of_tasks, rng=None):
     """
     Generate tasks for the generation of sine waves
     :param number_of_tasks: Number of tasks to generate
     :type number_of_tasks: int
+    :param rng: Random generator to sample from (default is NumPy's global random state)
+    :type rng: numpy.random.Generator
     :return: amplitude and phase generated samples for each possible task
     :rtype: dict
     """
-    return {"amplitude": np.random.uniform(amp_min, amp_max, size=number_of_tasks),
-            "phase": np.random.uniform(phase_min, phase_max, size=number_of_tasks)}
+    rng = np.random if rng is None else rng
+    return {"amplitude": rng.uniform(amp_min, amp_max, size=number_of_tasks),
+            "phase": rng.uniform(phase_min, phase_max, size=number_of_tasks)}
 
 
 def gen_sine_data(tasks, n_functions=10, sample_length=32, repetitions=40,
-                  n_ids=10, seed=None):
+                  n_ids=10, seed=None, rng=None):
     """
     Generate synthetic Incremental Sine Waves as defined in section 4.1
-    :param seed: Seed
+    :param seed: Seed of the random generator, used when no rng is given
     :param tasks: amplitude and phase generated samples for each possible task
     :type tasks: dict
     :param n_functions: number of functions to use (default is 10 as defined in the paper)
@@ -40,37 +42,46 @@ def gen_sine_data(tasks, n_functions=10, sample_length=32, repetitions=40,
     :type repetitions: int
     :param n_ids: number of ids to generate
     :type n_ids: int
+    :param rng: Random generator to sample from
+    :type rng: numpy.random.Generator
     :return: x trajectory samples, y trajectory samples, x random samples, y random samples
-    :rtype numpy.ndarray (n_functions * repetitions x sample_length x n_ids),
-           numpy.ndarray (n_functions * repetitions x sample_length),
-           numpy.ndarray (n_functions x sample_length x n_ids),
+    :rtype numpy.ndarray (n_functions x repetitions x sample_length x n_ids + 1),
+           numpy.ndarray (n_functions x repetitions x sample_length),
+           numpy.ndarray (n_functions x sample_length x n_ids + 1),
            numpy.ndarray (n_functions x sample_length)
     """
-    random.seed(seed)
-    np.random.seed(seed)
-    tasks_subsample = random.sample(list(zip(tasks["amplitude"], tasks["phase"])), n_functions)  # tuples: (amp, phase)
-    amplitude = [task_parameters[0] for task_parameters in tasks_subsample]
-    phase = [s[1] for s in tasks_subsample]
+    if rng is None:
+        rng = np.random.default_rng(seed)
+    task_indexes = rng.choice(len(tasks["amplitude"]), size=n_functions, replace=False)
+    amplitude = np.asarray(tasks["amplitude"])[task_indexes, np.newaxis]
+    phase = np.asarray(tasks["phase"])[task_indexes, np.newaxis]
 
     # Sample z used as inputs of the sine functions
-    list_of_z_traj = np.random.uniform(z_min, z_max, size=(n_functions, repetitions, sample_length))
-    list_of_z_rand = np.random.uniform(z_min, z_max, size=(n_functions, sample_length))
+    z_traj = rng.uniform(z_min, z_max, size=(n_functions, repetitions, sample_length))
+    z_rand = rng.uniform(z_min, z_max, size=(n_functions, sample_length))
 
-    # Initialize input arrays
+    # For every function, "repetitions" instances of length "sample_length"
+    y_traj = np.sin(z_traj + phase[:, np.newaxis]) * amplitude[:, np.newaxis]
+    y_rand = np.sin(z_rand + phase) * amplitude
+
+    # Inputs are z followed by the one hot encoded id of the function
+    ids = 1 + (np.arange(n_functions) // 10) % 10
     x_traj = np.zeros(shape=(n_functions, repetitions, sample_length, n_ids + 1))
     x_rand = np.zeros(shape=(n_functions, sample_length, n_ids + 1))
-    y_traj = np.zeros(shape=(n_functions, repetitions, sample_length))
-    y_rand = np.zeros(shape=(n_functions, sample_length))
+    x_traj[..., 0] = z_traj
+    x_rand[..., 0] = z_rand
+    x_traj[np.arange(n_functions), :, :, ids] = 1
+    x_rand[np.arange(n_functions), :, ids] = 1
 
-    # For every function, sample "repetitions" instances of length "sample_length"
-    for ind in range(n_functions):
-        for repetition in range(repetitions):
-            y_traj[ind, repetition, :] = np.sin(list_of_z_traj[ind, repetition] + phase[ind]) * amplitude[ind]
-            x_traj[ind, repetition, :, 0] = list_of_z_traj[ind, repetition]
-            x_traj[ind, repetition, :, 1 + (ind // 10) % 10] = 1
+    return x_traj, y_traj, x_rand, y_rand
 
-        y_rand[ind, :] = np.sin(list_of_z_rand[ind] + phase[ind]) * amplitude[ind]
-        x_rand[ind, :, 0] = list_of_z_rand[ind]
-        x_rand[ind, :, 1 + (ind // 10) % 10] = 1
 
-    return x_traj, y_traj, x_rand, y_rand
+def sine_data_stream(tasks, n_functions=10, sample_length=32, repetitions=40, n_ids=10, rng=None):
+    """
+    Endlessly generate Incremental Sine Waves data sets from the same random generator
+    :return: generator of (x_traj, y_traj, x_rand, y_rand) as returned by gen_sine_data
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    while True:
+        yield gen_sine_data(tasks, n_functions, sample_length, repetitions, n_ids, rng=rng)
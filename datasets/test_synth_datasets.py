@@ -19,3 +19,24 @@ def test_data_partitioner():
         partition = synth_datasets.partition_sine_data(sine_data, pretraining_n_seq=4, evaluation_n_seq=5, seq_len=320)
     except Exception as e:
         assert type(e) == AttributeError
+
+
+def test_gen_sine_data_shapes_and_values():
+    import numpy as np
+    from datasets import synth_datasets
+
+    tasks = synth_datasets.gen_tasks(20)
+    x_traj, y_traj, x_rand, y_rand = synth_datasets.gen_sine_data(tasks, n_functions=10, sample_length=32,
+                                                                  repetitions=4, seed=0)
+    assert x_traj.shape == (10, 4, 32, 11)
+    assert y_traj.shape == (10, 4, 32)
+    assert x_rand.shape == (10, 32, 11)
+    assert y_rand.shape == (10, 32)
+    # Every sample carries exactly one id and its value lies on a sine wave of the sampled tasks
+    assert (x_traj[..., 1:].sum(axis=-1) == 1).all()
+    assert (x_rand[..., 1:].sum(axis=-1) == 1).all()
+    assert np.abs(y_traj).max() <= synth_datasets.amp_max
+
+    # The same seed gives the same data
+    same = synth_datasets.gen_sine_data(tasks, n_functions=10, sample_length=32, repetitions=4, seed=0)
+    assert all(np.array_equal(a, b) for a, b in zip((x_traj, y_traj, x_rand, y_rand), same))
@@ -0,0 +1,26 @@
+import os
+import threading
+
+import numpy as np
+
+
+def test_concurrent_save_array_writes_a_complete_array(tmpdir):
+    from datasets.tf_datasets import save_array
+    path = str(tmpdir.join("images.npy"))
+    array = np.arange(2 ** 22, dtype=np.int64)
+    errors = []
+
+    def save():
+        try:
+            save_array(path, array)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=save) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    np.testing.assert_array_equal(np.load(path), array)
+    assert os.listdir(str(tmpdir)) == ["images.npy"]
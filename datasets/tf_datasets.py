@@ -1,21 +1,24 @@
 """ Loader file for different Tensorflow datasets"""
 
+import os
+import tempfile
+
 import tensorflow as tf
 import tensorflow_datasets as tfds
 import numpy as np
 
 
-def resize(image):
+def resize(image, size=(84, 84)):
     """
-    Resize an image to 84x84
+    Resize an image to 84x84 (or the given size)
     """
-    image['image'] = tf.image.resize(image['image'], size=(84, 84))
+    image['image'] = tf.image.resize(image['image'], size=size)
     image['image'] = image['image'][:, :, 0]
     image['image'] = tf.expand_dims(image['image'], axis=-1)
     return image
 
 
-def load_omniglot(transform=True, verbose=1):
+def load_omniglot(transform=True, verbose=1, size=(84, 84)):
     """
     Load Omniglot Dataset
     """
@@ -27,8 +30,8 @@ def load_omniglot(transform=True, verbose=1):
 
     # Resize images to 84x84
     if transform:
-        background = background.map(lambda sample: resize(sample))
-        evaluation = evaluation.map(lambda sample: resize(sample))
+        background = background.map(lambda sample: resize(sample, size))
+        evaluation = evaluation.map(lambda sample: resize(sample, size))
 
     if verbose > 0:
         print("Downloaded {} dataset (v:{})".format(info.name, str(info.version)))
@@ -38,3 +41,60 @@ def load_omniglot(transform=True, verbose=1):
         print("Sample info: \n", background.element_spec)  # Inspect element
 
     return background, evaluation
+
+
+def dataset_to_arrays(data, batch_size=1024):
+    """
+    Gather the images and labels of a dataset into two arrays. Images are stored as uint8.
+    :return: images, labels
+    :rtype: (numpy.ndarray, numpy.ndarray)
+    """
+    images = []
+    labels = []
+    for batch in tfds.as_numpy(data.batch(batch_size)):
+        images.append(np.round(batch['image']).astype(np.uint8))
+        labels.append(batch['label'])
+    return np.concatenate(images), np.concatenate(labels)
+
+
+def save_array(path, array):
+    # Write to a temporary file first so that concurrent readers never see a partial array. Every writer has its own
+    # temporary file, e.g. workers that build the cache at the same time.
+    fd, temporary_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=os.path.basename(path),
+                                          suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.save(f, array)
+        os.replace(temporary_path, path)
+    except BaseException:
+        os.remove(temporary_path)
+        raise
+
+
+def load_omniglot_arrays(cache_dir="cache/omniglot", size=(84, 84), verbose=1):
+    """
+    Load the resized Omniglot splits, sorted by label, from a NumPy cache. The cache is created from TFDS on the
+    first call and is memory-mapped, so that processes loading it share the same pages.
+    :param cache_dir: Directory of the cache, a subdirectory is used for every image size
+    :param size: Size to resize the images to
+    :return: background (images, labels) and evaluation (images, labels)
+    :rtype: ((numpy.ndarray, numpy.ndarray), (numpy.ndarray, numpy.ndarray))
+    """
+    cache_dir = os.path.join(cache_dir, "{}x{}".format(*size))
+    splits = ["background", "evaluation"]
+    paths = {split: (os.path.join(cache_dir, split + "_images.npy"), os.path.join(cache_dir, split + "_labels.npy"))
+             for split in splits}
+
+    if not all(os.path.exists(path) for split in splits for path in paths[split]):
+        os.makedirs(cache_dir, exist_ok=True)
+        data = load_omniglot(verbose=verbose, size=size)
+        for split, split_data in zip(splits, data):
+            images, labels = dataset_to_arrays(split_data)
+            order = np.argsort(labels, kind='stable')
+            save_array(paths[split][0], images[order])
+            save_array(paths[split][1], labels[order])
+        if verbose > 0:
+            print("Cached Omniglot in {}".format(cache_dir))
+
+    return tuple((np.load(paths[split][0], mmap_mode='r'), np.load(paths[split][1], mmap_mode='r'))
+                 for split in splits)
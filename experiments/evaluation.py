@@ -1,13 +1,125 @@
+import threading
+
 import tensorflow as tf
 import numpy as np
 from datasets.synth_datasets import gen_sine_data
+from experiments.training import functional_forward, stack_weights
 from util.misc import factor_int
 
 
-def compute_loss(x, y, loss_function, tln, rln):
+class ModelPool:
+    """
+    Models deserialized once per checkpoint, together with a snapshot of their saved weights. Getting a model again
+    restores the snapshot instead of loading the checkpoint again.
+    """
+    def __init__(self, loader=tf.keras.models.load_model):
+        self.loader = loader
+        self.models = {}
+        self.snapshots = {}
+
+    def get(self, path, reset=True):
+        """
+        :param path: Checkpoint of the model
+        :param reset: Restore the saved weights of a model that has already been loaded
+        :rtype: tf.keras.Model
+        """
+        if path not in self.models:
+            self.models[path] = self.loader(path)
+            self.snapshots[path] = self.models[path].get_weights()
+        elif reset:
+            self.models[path].set_weights(self.snapshots[path])
+        return self.models[path]
+
+    def weights(self, path):
+        """
+        Saved weights of the checkpoint, without touching the model
+        """
+        if path not in self.snapshots:
+            self.get(path)
+        return self.snapshots[path]
+
+
+class AsyncEvaluation:
+    """
+    Runs an evaluation in a background thread on a snapshot of the weights of the models, so that training goes on
+    while it runs. At most one evaluation runs at a time, submitting waits for the previous one.
+    """
+    def __init__(self, evaluate, *models):
+        """
+        :param evaluate: Function of the snapshots of the models followed by the arguments given to submit
+        :param models: Models whose weights are evaluated
+        """
+        self.evaluate = evaluate
+        self.models = models
+        self.snapshots = [tf.keras.models.clone_model(model) for model in models]
+        self.thread = None
+        self.error = None
+
+    def submit(self, *args, **kwargs):
+        self.wait()
+        for snapshot, model in zip(self.snapshots, self.models):
+            snapshot.set_weights(model.get_weights())
+        self.thread = threading.Thread(target=self._run, args=args, kwargs=kwargs)
+        self.thread.start()
+
+    def _run(self, *args, **kwargs):
+        try:
+            self.evaluate(*self.snapshots, *args, **kwargs)
+        except Exception as e:
+            self.error = e
+
+    def wait(self):
+        """
+        Wait for the running evaluation
+        :raises: The exception of the evaluation if it failed
+        """
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+
+def compute_loss(x, y, loss_function, tln, rln=None):
+    if rln is None:
+        # x already holds representations of the RLN
+        return loss_function(y, tln(x))
     return loss_function(y, tln(rln(x)))
 
 
+def represent(x, rln, batch_size=None):
+    """
+    Representations of the frozen RLN for inputs with any number of leading dimensions
+    :param x: Inputs of shape (..., RLN input shape)
+    :param batch_size: Number of inputs represented at once, all of them if None
+    :return: Representations of shape (..., representation size)
+    """
+    x = tf.convert_to_tensor(x)
+    input_rank = len(rln.input_shape) - 1
+    leading_shape = x.shape[:x.shape.ndims - input_rank].as_list()
+    inputs = tf.reshape(x, [-1] + x.shape[x.shape.ndims - input_rank:].as_list())
+    if batch_size is None:
+        rep = rln(inputs)
+    else:
+        rep = tf.concat([rln(inputs[start:start + batch_size])
+                         for start in range(0, inputs.shape[0], batch_size)], axis=0)
+    return tf.reshape(rep, leading_shape + [rep.shape[-1]])
+
+
+def function_losses(x, y, loss_function, tln):
+    """
+    Loss of every function from a single forward pass over data stacked by function
+    :param x: Representations of shape (functions, samples, representation size)
+    :param y: Targets of shape (functions, samples)
+    :param loss_function: Keras loss, whose per sample losses are averaged per function
+    :return: Losses of shape (functions,)
+    """
+    output = tln(tf.reshape(x, [-1, x.shape[-1]]))
+    per_sample_losses = loss_function.call(tf.reshape(y, [-1, 1]), output)
+    return tf.reduce_mean(tf.reshape(per_sample_losses, y.shape), axis=1)
+
+
 def train_and_evaluate(x_train, y_train, x_val, y_val, rln, tln, optimizer,
                        loss_function, batch_size, epochs=1):
     results_3a = {}
@@ -15,6 +127,10 @@ def train_and_evaluate(x_train, y_train, x_val, y_val, rln, tln, optimizer,
     results_3a_tr = {}
     results_3b_tr = {}
 
+    # Only the TLN is trained, so the representations of all the data are computed once
+    x_train = represent(x_train, rln)
+    x_val = represent(x_val, rln)
+
     # For every class
     for cls in range(len(x_train)):
         for e in range(epochs):
@@ -28,37 +144,28 @@ def train_and_evaluate(x_train, y_train, x_val, y_val, rln, tln, optimizer,
             # Train with its data points using GD
             for x, y in data:
                 with tf.GradientTape() as tape:
-                    loss = compute_loss(x, y, loss_function, tln, rln)
+                    loss = compute_loss(x, y, loss_function, tln)
                 gradient_tln = tape.gradient(loss, tln.trainable_variables)
                 optimizer.apply_gradients(zip(gradient_tln,
                                               tln.trainable_variables))
 
-        # Calculate loss with seen data from training set
-        x_train_classes_seen = tf.concat([i for i in x_train[:cls + 1]], 0)
-        y_train_classes_seen = tf.concat([i for i in y_train[:cls + 1]], 0)
+        # Calculate loss with seen data from training and validation set, per
+        # function from a single pass over the stacked data of the seen functions
+        function_losses_tr = function_losses(x_train[:cls + 1],
+                                             y_train[:cls + 1],
+                                             loss_function, tln)
+        results_3a_tr[cls + 1] = float(tf.reduce_mean(function_losses_tr))
 
-        training_loss = compute_loss(x_train_classes_seen,
-                                     y_train_classes_seen,
-                                     loss_function, tln, rln)
-        results_3a_tr[cls + 1] = training_loss.numpy()
+        function_losses_val = function_losses(x_val[:cls + 1],
+                                              y_val[:cls + 1],
+                                              loss_function, tln)
+        results_3a[cls + 1] = float(tf.reduce_mean(function_losses_val))
 
-        # Calculate loss with unseen data from validation set
-        x_val_classes_seen = tf.concat([i for i in x_val[:cls + 1]], 0)
-        y_val_classes_seen = tf.concat([i for i in y_val[:cls + 1]], 0)
-
-        validation_loss = compute_loss(x_val_classes_seen, y_val_classes_seen,
-                                       loss_function, tln, rln)
-        results_3a[cls + 1] = validation_loss.numpy()
-
-    data_iter = tf.data.Dataset.from_tensor_slices((x_val, y_val))
-    for i, (x, y) in enumerate(data_iter):
-        results_3b[i + 1] = compute_loss(x, y, loss_function,
-                                         tln, rln).numpy()
-
-    data_iter = tf.data.Dataset.from_tensor_slices((x_train, y_train))
-    for i, (x, y) in enumerate(data_iter):
-        results_3b_tr[i + 1] = compute_loss(x, y, loss_function,
-                                            tln, rln).numpy()
+    # After the last function all functions are seen, so the per function
+    # losses of the last step are the interference losses
+    for i in range(len(x_train)):
+        results_3b[i + 1] = float(function_losses_val[i])
+        results_3b_tr[i + 1] = float(function_losses_tr[i])
 
     validation_results = results_3a, results_3b
     training_results = results_3a_tr, results_3b_tr
@@ -91,6 +198,76 @@ def evaluate_models_isw(x_train, y_train, x_val, y_val, tln, rln,
     return training_losses, validation_losses
 
 
+def learning_rate_search_isw(x_train, y_train, x_val, y_val, tln, rln,
+                             learning_rates, batch_size=8, epochs=1):
+    """
+    Evaluate every learning rate of evaluate_models_isw in a single pass. One
+    copy of the TLN per learning rate is trained in lock-step, all of them
+    starting from the current weights of the TLN and sharing the RLN
+    representations. The TLN itself is not modified.
+    :param learning_rates: Learning rates to try
+    :return: Mean validation loss over the functions of every learning rate
+    :rtype: numpy.ndarray
+    """
+    loss_function = tf.keras.losses.MeanSquaredError()
+    x_train = represent(x_train, rln)
+    x_val = represent(x_val, rln)
+
+    weights = stack_weights(tln.trainable_variables, len(learning_rates))
+    learning_rates = tf.constant(learning_rates, dtype=tf.float32)
+    for cls in range(len(x_train)):
+        for e in range(epochs):
+            weights = train_runs_isw(x_train[cls], y_train[cls], weights,
+                                     learning_rates, tln, loss_function,
+                                     batch_size)
+
+    # Every function has the same number of samples, so the mean over the
+    # functions is the mean over all samples
+    output = functional_forward(tln, weights, tf.reshape(
+        x_val, [1, -1, x_val.shape[-1]]))
+    losses = loss_function.call(tf.reshape(y_val, [1, -1, 1]), output)
+    return tf.reduce_mean(losses, axis=1).numpy()
+
+
+def trial_seeds(search_seed, tests):
+    """
+    Seeds of the evaluation trials that follow a learning rate search. They
+    never include the seed of the search data, so that no trial is tested on
+    the data its learning rate was chosen on.
+    :param search_seed: Seed of the data of the learning rate search
+    :param tests: Number of trials
+    :rtype: list
+    """
+    return [search_seed + 1 + i for i in range(tests)]
+
+
+@tf.function
+def train_runs_isw(x, y, weights, learning_rates, tln, loss_function,
+                   batch_size):
+    """
+    Mini-batch SGD on the data of one function for TLN weights stacked along
+    a leading axis, with one learning rate per copy
+    :param x: Representations of shape (samples, representation size)
+    :return: Trained weights
+    """
+    n_runs = learning_rates.shape[0]
+    for start in tf.range(0, tf.shape(x)[0], batch_size):
+        x_batch = tf.expand_dims(x[start:start + batch_size], axis=0)
+        y_batch = tf.reshape(y[start:start + batch_size], [1, -1, 1])
+        with tf.GradientTape() as tape:
+            tape.watch(weights)
+            output = functional_forward(tln, weights, x_batch)
+            losses = loss_function.call(
+                tf.broadcast_to(y_batch, tf.shape(output)), output)
+            # Summing the losses of the copies keeps their gradients apart
+            loss = tf.reduce_sum(tf.reduce_mean(losses, axis=1))
+        gradients = tape.gradient(loss, weights)
+        weights = [w - tf.reshape(learning_rates,
+                                  [n_runs] + [1] * (w.shape.ndims - 1)) * g
+                   for w, g in zip(weights, gradients)]
+    return weights
+
+
 def prepare_data_evaluation(tasks, n_functions, sample_length, repetitions,
                             seed=None):
 
@@ -119,11 +296,11 @@ def prepare_data_evaluation(tasks, n_functions, sample_length, repetitions,
 
 
 def compute_sparsity(x, rln, tln):
-    rep = rln(x)
-    rep = np.array(rep)
-    counts = np.isclose(rep, 0).sum(axis=1) / rep.shape[1]
-    sparsity = np.mean(counts)
-    return sparsity
+    """
+    Fraction of zero (as in np.isclose) elements of the representations, reduced on the device
+    """
+    rep = tf.cast(rln(x), tf.float32)
+    return float(tf.reduce_mean(tf.cast(tf.abs(rep) <= 1e-8, tf.float32)))
 
 
 def get_representations_graphics(x, rln):
@@ -131,7 +308,8 @@ def get_representations_graphics(x, rln):
     rep = rln(x)
     rep_len = rep.shape[-1]
     rep_f1, rep_f2 = factor_int(rep_len)
-    rep = [tf.reshape(r, (rep_f1, rep_f2, 1)) for r in rep]
-    rep = [r / tf.reduce_max(r) for r in rep]
-    rep = tf.random.shuffle(tf.stack(rep))
+    # Every representation as an image, normalized by its maximum
+    rep = tf.reshape(rep, (-1, rep_f1, rep_f2, 1))
+    rep = rep / tf.reduce_max(rep, axis=[1, 2, 3], keepdims=True)
+    rep = tf.random.shuffle(rep)
     return rep
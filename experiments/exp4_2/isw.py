@@ -68,3 +68,18 @@ def mrcl_isw(n_layers_rln=6, n_layers_tln=2, hidden_units_per_layer=300, one_hot
                      seed=seed)
     tln = tf.keras.Model(inputs=input_tln, outputs=y)
     return rln, tln
+
+
+def mrcl_isw_from_weights(rln_weights, tln_weights):
+    """
+    MRCL model with the architecture of the given weights, e.g. of a checkpoint written by WeightCheckpoints
+    :param rln_weights: Weights of the RLN as returned by get_weights
+    :param tln_weights: Weights of the TLN as returned by get_weights
+    :rtype: (tf.keras.Model, tf.keras.Model)
+    """
+    rln, tln = mrcl_isw(n_layers_rln=len(rln_weights) // 2, n_layers_tln=len(tln_weights) // 2 - 1,
+                        hidden_units_per_layer=rln_weights[0].shape[1], one_hot_depth=rln_weights[0].shape[0] - 1,
+                        representation_size=rln_weights[-1].shape[0])
+    rln.set_weights(rln_weights)
+    tln.set_weights(tln_weights)
+    return rln, tln
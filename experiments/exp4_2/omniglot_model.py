@@ -1,12 +1,15 @@
-from operator import itemgetter
-import tensorflow_datasets as tfds
 import tensorflow as tf
 import numpy as np
-from experiments.training import copy_parameters
+from datasets.tf_datasets import dataset_to_arrays
+from experiments.evaluation import represent
+from experiments.training import copy_parameters, fast_weights_update, functional_forward, stack_weights, \
+    compact_sparse, compacted_size, sparse_functional_forward
+from util.profiling import no_timer
 
 
 def mrcl_omniglot_rln(inputs, n_layers, filters, strides=[2, 1, 2, 1, 2, 2]):
-    h = inputs
+    # Images are kept as uint8 until they reach the model
+    h = tf.cast(inputs, tf.float32)
     for i in range(n_layers):
         h = tf.keras.layers.Conv2D(filters, (3, 3), activation='relu', input_shape=(84, 84, 1), strides=strides[i])(h)
     h = tf.keras.layers.Flatten()(h)
@@ -21,45 +24,88 @@ def mrcl_omniglot_tln(inputs, n_layers, hidden_units_per_layer, output=964):
     return y
 
 
+def mrcl_omniglot_tln_model(tln_layers=2, hidden_units=300, classes=964, representation_size=3 * 3 * 256):
+    """
+    TLN of mrcl_omniglot on its own, e.g. for training on precomputed representations
+    """
+    input_tln = tf.keras.Input(shape=representation_size)
+    y = mrcl_omniglot_tln(input_tln, tln_layers, hidden_units, output=classes)
+    return tf.keras.Model(inputs=input_tln, outputs=y)
+
+
 def mrcl_omniglot(rln_layers=6, tln_layers=2, filters=256, hidden_units=300, classes=964):
-    input_rln = tf.keras.Input(shape=(84, 84, 1))
-    input_tln = tf.keras.Input(shape=3 * 3 * 256)
+    input_rln = tf.keras.Input(shape=(84, 84, 1), dtype=tf.uint8)
     h = mrcl_omniglot_rln(input_rln, rln_layers, filters)
     rln = tf.keras.Model(inputs=input_rln, outputs=h)
-    y = mrcl_omniglot_tln(input_tln, tln_layers, hidden_units, output=classes)
-    tln = tf.keras.Model(inputs=input_tln, outputs=y)
+    tln = mrcl_omniglot_tln_model(tln_layers, hidden_units, classes)
     return rln, tln
 
 
-def get_background_data_by_classes(background_data, sort=True):
+class ClassIndexedData:
+    """
+    Samples grouped by class in contiguous arrays: images of shape (classes, samples per class, 84, 84, 1) stored as
+    uint8 and labels of shape (classes, samples per class). Indexing returns a view on the selected classes/samples.
+    Images can also be replaced by their RLN representations, see represent_data_by_classes.
+    """
+    def __init__(self, images, labels):
+        self.images = images
+        self.labels = labels
+
+    def __len__(self):
+        return self.images.shape[0]
+
+    def __getitem__(self, index):
+        return ClassIndexedData(self.images[index], self.labels[index])
+
+    @property
+    def samples_per_class(self):
+        return self.images.shape[1]
+
+
+def get_data_by_classes(data, sort=True, samples_per_class=20):
+    """
+    Gather Omniglot samples into contiguous arrays grouped by class
+    :param data: Dataset of samples with an image and a label, or (images, labels) arrays as returned by
+                 load_omniglot_arrays
+    :type data: tf.data.Dataset or (numpy.ndarray, numpy.ndarray)
+    :param sort: Group samples by label. Otherwise samples are shuffled and grouped regardless of their label.
+    :type sort: bool
+    :param samples_per_class: Number of samples of every class
+    :type samples_per_class: int
+    :rtype: ClassIndexedData
+    """
+    if isinstance(data, tuple):
+        images, labels = data
+    else:
+        images, labels = dataset_to_arrays(data)
+
     if sort:
-        background_data = np.array(sorted(list(tfds.as_numpy(background_data)), key=itemgetter('label')))
+        # Already sorted arrays (e.g. memory-mapped from the cache) are only reshaped, without copying
+        if np.any(labels[1:] < labels[:-1]):
+            order = np.argsort(labels, kind='stable')
+            images, labels = images[order], labels[order]
     else:
-        background_data = np.array(list(tfds.as_numpy(background_data)))
-        np.random.shuffle(background_data)
+        order = np.random.permutation(len(labels))
+        images, labels = images[order], labels[order]
+    number_of_classes = len(labels) // samples_per_class
+    images = images.reshape((number_of_classes, samples_per_class) + images.shape[1:])
+    labels = labels.reshape((number_of_classes, samples_per_class))
+    return ClassIndexedData(images, labels)
 
-    background_training_data = []
-    background_training_data_15 = []
-    background_training_data_5 = []
-    background_number_of_classes = int(background_data.shape[0] / 20)
 
-    for i in range(background_number_of_classes):
-        background_training_data.append(background_data[i * 20:(i + 1) * 20])
-        background_training_data_15.append(background_data[i * 20:i * 20 + 15])
-        background_training_data_5.append(background_data[i * 20 + 15:(i + 1) * 20])
+def get_background_data_by_classes(background_data, sort=True):
+    background_training_data = get_data_by_classes(background_data, sort=sort)
+    background_training_data_15 = background_training_data[:, :15]
+    background_training_data_5 = background_training_data[:, 15:]
 
     return background_training_data, background_training_data_15, background_training_data_5
 
 
 def get_eval_data_by_classes(evaluation_data):
-    evaluation_data = np.array(sorted(list(tfds.as_numpy(evaluation_data)), key=itemgetter('label')))
-   
-    evaluation_training_data = []
-    evaluation_test_data = []
-    evaluation_number_of_classes = int(evaluation_data.shape[0] / 20)
-    for i in range(evaluation_number_of_classes):
-        evaluation_training_data.append(evaluation_data[i * 20:i * 20 + 15])
-        evaluation_test_data.append(evaluation_data[i * 20 + 15:(i + 1) * 20])
+    evaluation_data = get_data_by_classes(evaluation_data)
+
+    evaluation_training_data = evaluation_data[:, :15]
+    evaluation_test_data = evaluation_data[:, 15:]
 
     return evaluation_training_data, evaluation_test_data
 
@@ -71,64 +117,157 @@ def partition_into_disjoint(data):
     return s_learn, s_remember
 
 
+def to_tensors(images, labels):
+    # Images stay uint8, the RLN converts them on the device
+    return tf.convert_to_tensor(images, dtype=tf.uint8), tf.convert_to_tensor(labels)
+
+
 def sample_trajectory(s_learn, data):
     random_class = np.random.choice(s_learn)
-    x_traj = []
-    y_traj = []
-    for item in data[random_class]:
-        x_traj.append(item['image'])
-        y_traj.append(item['label'])
-    return tf.convert_to_tensor(x_traj), tf.convert_to_tensor(y_traj)
+    return to_tensors(data.images[random_class], data.labels[random_class])
 
 
 def sample_random(s_remember, data):
     random_class = np.random.choice(s_remember)
-    x_rand = []
-    y_rand = []
-    for item in data[random_class]:
-        x_rand.append(item['image'])
-        y_rand.append(item['label'])
-    return tf.convert_to_tensor(x_rand), tf.convert_to_tensor(y_rand)
+    return to_tensors(data.images[random_class], data.labels[random_class])
+
 
 def sample_random_10_classes(s_remember, data):
     random_classes = np.random.choice(s_remember, 10)
-    x_rand = []
-    y_rand = []
-    for random_class in random_classes:
-        random_index = np.random.choice(list(range(20)))
-        x_rand.append(data[random_class][random_index]['image'])
-        y_rand.append(data[random_class][random_index]['label'])
-    return tf.convert_to_tensor(x_rand), tf.convert_to_tensor(y_rand)
-
-
-def pretrain_classification_mrcl(x_traj, y_traj, x_rand, y_rand, rln, tln, tln_initial, classification_parameters):
+    random_indexes = np.random.choice(data.samples_per_class, 10)
+    return to_tensors(data.images[random_classes, random_indexes], data.labels[random_classes, random_indexes])
+
+
+def sample_meta_batch(s_learn, s_remember, data, meta_batch_size):
+    """
+    Sample meta_batch_size trajectories and remember sets, stacked along a leading meta-batch axis
+    :return: x_traj, y_traj, x_rand, y_rand
+    """
+    random_classes = np.random.choice(s_learn, meta_batch_size)
+    x_traj, y_traj = to_tensors(data.images[random_classes], data.labels[random_classes])
+
+    random_classes = np.random.choice(s_remember, (meta_batch_size, 10))
+    random_indexes = np.random.choice(data.samples_per_class, (meta_batch_size, 10))
+    x_rand, y_rand = to_tensors(data.images[random_classes, random_indexes],
+                                data.labels[random_classes, random_indexes])
+    return x_traj, y_traj, x_rand, y_rand
+
+
+def pretrain_classification_mrcl(x_traj, y_traj, x_rand, y_rand, rln, tln, tln_initial, classification_parameters,
+                                 fast_weights=False, jit_compile=False, workers=None, timer=no_timer):
+    """
+    One MRCL meta-update. Under a mixed_bfloat16 policy the models compute in bfloat16 while their variables, the
+    losses and the gradients stay in float32. bfloat16 has the exponent range of float32, so small gradients don't
+    underflow and, unlike float16, no loss scaling is needed.
+    :param jit_compile: Compile the fast weights meta-update with XLA
+    :param workers: WorkerGroup of a data-parallel pretraining, every worker passes its own samples and the outer
+                    gradients are averaged over the workers
+    :param timer: PhaseTimer of the phases of the meta-update
+    :return: Outer loss (averaged over the workers)
+    """
     # Random reinitialization of last layer
     w = tln.layers[-1].weights[0]
     new_w = tln.layers[-1].kernel_initializer(shape=w.shape)
+    if workers is not None:
+        new_w, = workers.broadcast([new_w])
     tln.layers[-1].weights[0].assign(new_w)
 
-    # Clone tln to preserve initial weights
-    copy_parameters(tln, tln_initial)
+    if fast_weights:
+        if x_traj.shape.ndims == 4:
+            # Single trajectory, add the meta-batch axis
+            x_traj, y_traj, x_rand, y_rand = [tf.expand_dims(t, axis=0) for t in (x_traj, y_traj, x_rand, y_rand)]
+        x_meta = tf.concat([x_rand, x_traj], axis=1)
+        y_meta = tf.concat([y_rand, y_traj], axis=1)
+
+        # The inner loop does not touch the TLN variables, so there is nothing to preserve or restore
+        meta_gradients = meta_gradients_fast_weights_xla() if jit_compile else meta_gradients_fast_weights
+        with timer.phase("meta_gradients"):
+            outer_loss, tln_gradients, rln_gradients = meta_gradients(
+                x_traj, y_traj, x_meta, y_meta, rln, tln, classification_parameters["inner_learning_rate"],
+                classification_parameters["loss_function"])
+        tln_variables = tln.trainable_variables
+    else:
+        x_meta = tf.concat([x_rand, x_traj], axis=0)
+        y_meta = tf.concat([y_rand, y_traj], axis=0)
+
+        # Clone tln to preserve initial weights
+        with timer.phase("copies"):
+            copy_parameters(tln, tln_initial)
+
+        with timer.phase("inner_loop"):
+            for x, y in zip(x_traj, y_traj):
+                inner_update(x, y, rln, tln, classification_parameters)
+
+        with timer.phase("outer_gradient"):
+            with tf.GradientTape(persistent=True) as theta_tape:
+                outer_loss, _ = compute_loss(x_meta, y_meta, rln, tln, classification_parameters)
+
+            tln_gradients = theta_tape.gradient(outer_loss, tln.trainable_variables)
+            rln_gradients = theta_tape.gradient(outer_loss, rln.trainable_variables)
+            del theta_tape
+        tln_variables = tln_initial.trainable_variables
+
+    if workers is not None:
+        with timer.phase("all_reduce"):
+            outer_loss, *gradients = workers.mean([outer_loss] + tln_gradients + rln_gradients)
+        tln_gradients, rln_gradients = gradients[:len(tln_gradients)], gradients[len(tln_gradients):]
+
+    with timer.phase("optimizer"):
+        classification_parameters["meta_optimizer"](
+            learning_rate=classification_parameters["meta_learning_rate"]).apply_gradients(
+            zip(tln_gradients + rln_gradients, tln_variables + rln.trainable_variables))
+
+    if not fast_weights:
+        with timer.phase("copies"):
+            copy_parameters(tln_initial, tln)
+    return outer_loss
 
-    x_meta = tf.concat([x_rand, x_traj], axis=0)
-    y_meta = tf.concat([y_rand, y_traj], axis=0)
 
-    for x, y in zip(x_traj, y_traj):
-        inner_update(x, y, rln, tln, classification_parameters)
+@tf.function
+def meta_gradients_fast_weights(x_traj, y_traj, x_meta, y_meta, rln, tln, inner_learning_rate, loss_function):
+    """
+    Inner loop and outer gradients of an MRCL meta-update using fast weights for the TLN. All inputs have a leading
+    meta-batch axis, the trajectories are processed in parallel on stacked fast weights.
+    :return: outer loss, gradients w.r.t. the TLN weights, gradients w.r.t. the RLN weights (averaged over tasks)
+    """
+    n_tasks = x_traj.shape[0]
+    image_shape = x_traj.shape[2:].as_list()
 
-    with tf.GradientTape(persistent=True) as theta_tape:
-        outer_loss, _ = compute_loss(x_meta, y_meta, rln, tln, classification_parameters)
+    # The RLN is not updated in the inner loop, so the trajectories are represented in a single batched pass
+    rep_traj = tf.reshape(rln(tf.reshape(x_traj, [-1] + image_shape)), [n_tasks, x_traj.shape[1], -1])
 
-    tln_gradients = theta_tape.gradient(outer_loss, tln.trainable_variables)
-    rln_gradients = theta_tape.gradient(outer_loss, rln.trainable_variables)
-    del theta_tape
+    # The loss is averaged over the tasks, scaling it back keeps each task's inner gradient independent of the others
+    def inner_loss_function(output, y):
+        return n_tasks * loss_function(y, tf.cast(output, tf.float32))
 
-    classification_parameters["meta_optimizer"](
-        learning_rate=classification_parameters["meta_learning_rate"]).apply_gradients(
-        zip(tln_gradients + rln_gradients, tln_initial.trainable_variables + rln.trainable_variables))
+    weights = stack_weights(tln.trainable_variables, n_tasks)
+    for i in tf.range(tf.shape(rep_traj)[1]):
+        weights = fast_weights_update(rep_traj[:, i:i + 1], y_traj[:, i:i + 1], weights, tln, inner_learning_rate,
+                                      inner_loss_function)
 
-    copy_parameters(tln_initial, tln)
-    return outer_loss
+    with tf.GradientTape() as theta_tape:
+        theta_tape.watch(weights)
+        rep_meta = tf.reshape(rln(tf.reshape(x_meta, [-1] + image_shape)), [n_tasks, x_meta.shape[1], -1])
+        outer_loss = loss_function(y_meta, tf.cast(functional_forward(tln, weights, rep_meta), tf.float32))
+
+    gradients = theta_tape.gradient(outer_loss, weights + rln.trainable_variables)
+    # Summing the stacked gradients of the mean outer loss averages the per-task gradients
+    tln_gradients = [tf.reduce_sum(g, axis=0) for g in gradients[:len(weights)]]
+    return outer_loss, tln_gradients, gradients[len(weights):]
+
+
+_meta_gradients_fast_weights_xla = None
+
+
+def meta_gradients_fast_weights_xla():
+    """
+    meta_gradients_fast_weights compiled with XLA. It is built on the first call, since older TensorFlow versions do
+    not know tf.function's jit_compile argument and importing this module must not depend on it.
+    """
+    global _meta_gradients_fast_weights_xla
+    if _meta_gradients_fast_weights_xla is None:
+        _meta_gradients_fast_weights_xla = tf.function(meta_gradients_fast_weights.python_function, jit_compile=True)
+    return _meta_gradients_fast_weights_xla
 
 
 #@tf.function
@@ -147,44 +286,66 @@ def compute_loss(x, y, rln, tln, classification_parameters):
         output = tln(rln(tf.expand_dims(x, axis=0)))
     else:
         output = tln(rln(x))
+    # Losses are computed in float32 also when the models compute in a lower precision
+    output = tf.cast(output, tf.float32)
     loss = classification_parameters["loss_function"](y, output)
     return loss, output
 
 
-def evaluate_classification_mrcl(training_data, testing_data, rln, tln, number_of_classes, classification_parameters):
+def sample_evaluation_episode(training_data, testing_data, number_of_classes, rng=None):
+    """
+    Sample number_of_classes classes for online training and evaluation, relabeled in the order they were sampled
+    :param rng: Random generator to sample from (default is NumPy's global random state)
+    :type rng: numpy.random.Generator
+    :return: x_training, y_training, x_testing, y_testing
+    :rtype: numpy.ndarray
+    """
+    rng = np.random if rng is None else rng
     all_classes = list(range(len(training_data)))
-    classes_to_use = np.random.choice(all_classes, number_of_classes)
-
-    x_training = []
-    y_training = []
-    x_testing = []
-    y_testing = []
-    temp_class_id = 0
-    for class_id in classes_to_use:
-        for training_item in training_data[class_id]:
-            x_training.append(training_item['image'])
-            y_training.append(temp_class_id)
-        for testing_item in testing_data[class_id]:
-            x_testing.append(testing_item['image'])
-            y_testing.append(temp_class_id)
-        temp_class_id = temp_class_id + 1
-
-    x_training = tf.convert_to_tensor(x_training)
+    classes_to_use = rng.choice(all_classes, number_of_classes)
+
+    x_training = training_data.images[classes_to_use].reshape((-1,) + training_data.images.shape[2:])
+    y_training = np.repeat(np.arange(number_of_classes, dtype=np.int32), training_data.samples_per_class)
+    x_testing = testing_data.images[classes_to_use].reshape((-1,) + testing_data.images.shape[2:])
+    y_testing = np.repeat(np.arange(number_of_classes, dtype=np.int32), testing_data.samples_per_class)
+    return x_training, y_training, x_testing, y_testing
+
+
+def represent_data_by_classes(data, rln, batch_size=256):
+    """
+    Compute the representations of the frozen RLN for all images once, so that online evaluation only runs the TLN
+    :type data: ClassIndexedData
+    :return: Representations of shape (classes, samples per class, representation size) with the same labels
+    :rtype: ClassIndexedData
+    """
+    return ClassIndexedData(represent(data.images, rln, batch_size).numpy(), data.labels)
+
+
+def evaluate_classification_mrcl(training_data, testing_data, rln, tln, number_of_classes, classification_parameters,
+                                 sparse=False):
+    """
+    :param sparse: Train on the compacted nonzero elements of the representations if they are sparse enough, see
+                   online_training_sparse
+    """
+    x_training, y_training, x_testing, y_testing = sample_evaluation_episode(training_data, testing_data,
+                                                                             number_of_classes)
+
+    # The RLN is frozen, so every image of the episode is represented only once
+    x_training = represent(x_training, rln, batch_size=256)
+    x_testing = represent(x_testing, rln, batch_size=256)
     y_training = tf.convert_to_tensor(y_training)
-    x_testing = tf.convert_to_tensor(x_testing)
     y_testing = tf.convert_to_tensor(y_testing)
-    for m in range(x_training.shape[0]):
-        with tf.GradientTape() as tape:
-            loss, _ = compute_loss(x_training[m], y_training[m], rln, tln, classification_parameters)
-        gradient_tln = tape.gradient(loss, tln.trainable_variables)
-        classification_parameters['online_optimizer'](
-            learning_rate=classification_parameters['online_learning_rate']).apply_gradients(
-            zip(gradient_tln, tln.trainable_variables))
+    learning_rate = tf.constant(classification_parameters['online_learning_rate'], dtype=tf.float32)
+    compacted = compact_sparse(x_training) if sparse else None
+    if compacted is None:
+        online_training(x_training, y_training, tln, learning_rate, classification_parameters["loss_function"])
+    else:
+        online_training_sparse(*compacted, y_training, tln, learning_rate, classification_parameters["loss_function"])
 
     data = tf.data.Dataset.from_tensor_slices((x_training, y_training)).batch(256)
     total_correct = 0
     for x, y in data:
-        loss, output = compute_loss(x, y, rln, tln, classification_parameters)
+        output = tln(x)
         after_softmax = tf.nn.softmax(output, axis=1)
         correct_prediction = tf.equal(tf.cast(tf.argmax(after_softmax, axis=1), tf.int32), y)
         total_correct = total_correct + tf.reduce_sum(tf.cast(correct_prediction, tf.float32))
@@ -193,7 +354,7 @@ def evaluate_classification_mrcl(training_data, testing_data, rln, tln, number_o
     data = tf.data.Dataset.from_tensor_slices((x_testing, y_testing)).batch(256)
     total_correct = 0
     for x, y in data:
-        loss, output = compute_loss(x, y, rln, tln, classification_parameters)
+        output = tln(x)
         after_softmax = tf.nn.softmax(output, axis=1)
         correct_prediction = tf.equal(tf.cast(tf.argmax(after_softmax, axis=1), tf.int32), y)
         total_correct = total_correct + tf.reduce_sum(tf.cast(correct_prediction, tf.float32))
@@ -201,6 +362,222 @@ def evaluate_classification_mrcl(training_data, testing_data, rln, tln, number_o
     return test_accuracy.numpy(), train_accuracy.numpy()
 
 
+@tf.function
+def online_training(x_training, y_training, tln, learning_rate, loss_function):
+    """
+    SGD on one sample at a time. The learning rate is a tensor, so that every learning rate reuses the same graph.
+    :param x_training: RLN representations of shape (samples, representation size)
+    """
+    for m in tf.range(tf.shape(x_training)[0]):
+        with tf.GradientTape() as tape:
+            loss = loss_function(y_training[m:m + 1], tln(x_training[m:m + 1]))
+        gradient_tln = tape.gradient(loss, tln.trainable_variables)
+        for g, v in zip(gradient_tln, tln.trainable_variables):
+            v.assign_sub(learning_rate * g)
+
+
+@tf.function
+def online_training_sparse(indices, values, y_training, tln, learning_rate, loss_function):
+    """
+    online_training of sparse representations compacted by compact_sparse. The first TLN layer only reads and
+    updates the kernel rows of the nonzero elements of every sample, the gradient of the kernel is an IndexedSlices.
+    """
+    kernel = tln.trainable_variables[0]
+    for m in tf.range(tf.shape(values)[0]):
+        with tf.GradientTape() as tape:
+            rows = tf.gather(kernel, indices[m:m + 1])
+            output = sparse_functional_forward(tln, [rows] + tln.trainable_variables[1:], values[m:m + 1])
+            loss = loss_function(y_training[m:m + 1], output)
+        gradient_tln = tape.gradient(loss, tln.trainable_variables)
+        for g, v in zip(gradient_tln, tln.trainable_variables):
+            if isinstance(g, tf.IndexedSlices):
+                v.scatter_sub(tf.IndexedSlices(learning_rate * g.values, g.indices))
+            else:
+                v.assign_sub(learning_rate * g)
+
+
+def initial_tln_weights(tln, seed=None):
+    """
+    Weights of a freshly initialized copy of the TLN
+    :param seed: Seed of the initializers of the Dense layers, unseeded if None
+    """
+    if seed is None:
+        return tf.keras.models.clone_model(tln).get_weights()
+    layers = [layer for layer in tln.layers if layer.trainable_weights]
+    layer_seeds = np.random.default_rng(seed).integers(2 ** 31, size=len(layers))
+    weights = []
+    for layer, layer_seed in zip(layers, layer_seeds):
+        kernel_initializer = layer.kernel_initializer.from_config(
+            dict(layer.kernel_initializer.get_config(), seed=int(layer_seed)))
+        weights += [kernel_initializer(layer.kernel.shape).numpy(), layer.bias_initializer(layer.bias.shape).numpy()]
+    return weights
+
+
+def evaluate_classification_mrcl_runs(training_data, testing_data, rln, tln, tln_weights, number_of_classes,
+                                      learning_rates, classification_parameters, max_parallel_runs=10, sparse=False,
+                                      sparse_size=None, seeds=None):
+    """
+    Run several online training and evaluation runs of evaluate_classification_mrcl in parallel. Every run samples
+    its own classes and trains its own copy of the TLN, from its own initial weights and with its own learning
+    rate, with SGD on one sample at a time. The RLN is shared by all runs and every image is represented only once.
+    :param rln: Frozen RLN, or None if training_data and testing_data already hold the RLN representations
+    :param tln: TLN model defining the architecture of the copies
+    :param tln_weights: Initial TLN weights of every run
+    :param learning_rates: Online learning rate of every run
+    :param max_parallel_runs: Maximum number of runs trained together
+    :param sparse: Train on the compacted nonzero elements of the representations if they are sparse enough, see
+                   online_training_runs_sparse
+    :param sparse_size: Number of elements of the compacted representations of every batch of runs, see
+                        compact_sparse. A fixed size avoids tracing the online training again for other sizes.
+    :param seeds: Seed of the episode of every run, NumPy's global random state is used if None
+    :return: test accuracies, train accuracies of every run
+    :rtype: (numpy.ndarray, numpy.ndarray)
+    """
+    test_accuracies = []
+    train_accuracies = []
+    for start in range(0, len(learning_rates), max_parallel_runs):
+        runs = range(start, min(start + max_parallel_runs, len(learning_rates)))
+        episodes = [sample_evaluation_episode(training_data, testing_data, number_of_classes,
+                                              rng=None if seeds is None else np.random.default_rng(seeds[run]))
+                    for run in runs]
+        x_training, y_training, x_testing, y_testing = [tf.convert_to_tensor(np.stack(e)) for e in zip(*episodes)]
+        if rln is not None:
+            x_training = represent(x_training, rln, batch_size=256)
+            x_testing = represent(x_testing, rln, batch_size=256)
+
+        weights = [tf.stack(w) for w in zip(*[tln_weights[run] for run in runs])]
+        run_learning_rates = tf.constant([learning_rates[run] for run in runs], dtype=tf.float32)
+        compacted = compact_sparse(x_training, size=sparse_size) if sparse else None
+        if compacted is None:
+            weights = online_training_runs(x_training, y_training, weights, run_learning_rates, tln,
+                                           classification_parameters["loss_function"])
+        else:
+            weights = [tf.Variable(w) for w in weights]
+            online_training_runs_sparse(*compacted, y_training, weights, run_learning_rates, tln,
+                                        classification_parameters["loss_function"])
+            weights = [w.read_value() for w in weights]
+
+        test_accuracies.append(accuracy_runs(x_testing, y_testing, weights, tln))
+        train_accuracies.append(accuracy_runs(x_training, y_training, weights, tln))
+    return np.concatenate(test_accuracies), np.concatenate(train_accuracies)
+
+
+@tf.function
+def online_training_runs(x_training, y_training, weights, learning_rates, tln, loss_function):
+    """
+    SGD on one sample at a time of every run in lock-step, on TLN weights stacked along a leading run axis
+    :param x_training: RLN representations of shape (runs, samples, representation size)
+    :return: trained TLN weights
+    """
+    n_runs = x_training.shape[0]
+    for m in tf.range(tf.shape(x_training)[1]):
+        rep = x_training[:, m:m + 1]
+        with tf.GradientTape() as tape:
+            tape.watch(weights)
+            # Summing the losses of the runs keeps their gradients independent
+            loss = n_runs * loss_function(y_training[:, m:m + 1], functional_forward(tln, weights, rep))
+        gradients = tape.gradient(loss, weights)
+        weights = [w - tf.reshape(learning_rates, [-1] + [1] * (w.shape.ndims - 1)) * g
+                   for w, g in zip(weights, gradients)]
+    return weights
+
+
+@tf.function
+def online_training_runs_sparse(indices, values, y_training, weights, learning_rates, tln, loss_function):
+    """
+    online_training_runs of sparse representations compacted by compact_sparse, updating the stacked weights in
+    place. The first TLN layer only reads and updates the kernel rows of the nonzero elements of every sample.
+    :param indices: Indices of the nonzero elements of shape (runs, samples, k)
+    :param values: Values of the nonzero elements of shape (runs, samples, k)
+    :param weights: Variables of the TLN weights stacked along a leading run axis
+    """
+    n_runs = values.shape[0]
+    kernel = weights[0]
+    run_indices = tf.tile(tf.reshape(tf.range(n_runs), [-1, 1]), [1, indices.shape[-1]])
+    for m in tf.range(tf.shape(values)[1]):
+        # Kernel rows of the nonzero elements of the sample of every run, of shape (runs, 1, k, units)
+        rows = tf.gather(kernel, indices[:, m:m + 1], batch_dims=1)
+        dense_weights = [w.read_value() for w in weights[1:]]
+        with tf.GradientTape() as tape:
+            tape.watch([rows] + dense_weights)
+            output = sparse_functional_forward(tln, [rows] + dense_weights, values[:, m:m + 1])
+            # Summing the losses of the runs keeps their gradients independent
+            loss = n_runs * loss_function(y_training[:, m:m + 1], output)
+        gradients = tape.gradient(loss, [rows] + dense_weights)
+        updates = [tf.reshape(learning_rates, [-1] + [1] * (g.shape.ndims - 1)) * g for g in gradients]
+        kernel.scatter_nd_sub(tf.stack([run_indices, indices[:, m]], axis=-1), updates[0][:, 0])
+        for w, update in zip(weights[1:], updates[1:]):
+            w.assign_sub(update)
+
+
+def accuracy_runs(x, y, weights, tln):
+    """
+    Accuracy of every run on its own samples, with TLN weights stacked along a leading run axis
+    :param x: RLN representations of shape (runs, samples, representation size)
+    :rtype: numpy.ndarray
+    """
+    predictions = tf.cast(tf.argmax(functional_forward(tln, weights, x), axis=-1), tf.int32)
+    return tf.reduce_mean(tf.cast(tf.equal(predictions, y), tf.float32), axis=1).numpy()
+
+
+class OmniglotEvaluator:
+    """
+    Online evaluation on top of a frozen RLN that is reused across runs, learning rates and numbers of classes. The
+    evaluation data is represented once and a TLN is built once per number of classes, so the compiled online
+    training steps are traced once per number of classes instead of being rebuilt for every run.
+    """
+    def __init__(self, training_data, testing_data, rln, classification_parameters, max_parallel_runs=10,
+                 sparse=False):
+        """
+        :param training_data: Evaluation samples used for online training
+        :type training_data: ClassIndexedData
+        :param testing_data: Evaluation samples of the same classes used for testing
+        :type testing_data: ClassIndexedData
+        :param rln: Frozen RLN
+        :param sparse: Online training on the compacted nonzero elements of sparse representations, see
+                       evaluate_classification_mrcl_runs
+        """
+        self.training_data = represent_data_by_classes(training_data, rln)
+        self.testing_data = represent_data_by_classes(testing_data, rln)
+        self.classification_parameters = classification_parameters
+        self.max_parallel_runs = max_parallel_runs
+        # A single compacted size for all the episodes, so that the online training is still traced once per number
+        # of classes. Representations that are too dense are trained with the dense products.
+        self.sparse_size = compacted_size(self.training_data.images, round_up=False) if sparse else None
+        self.sparse = self.sparse_size is not None
+        self.tlns = {}
+
+    def tln(self, number_of_classes):
+        """
+        TLN with number_of_classes outputs, built on the first call
+        """
+        if number_of_classes not in self.tlns:
+            # The data is already represented, so the RLN isn't built
+            self.tlns[number_of_classes] = mrcl_omniglot_tln_model(
+                classes=number_of_classes, representation_size=self.training_data.images.shape[-1])
+        return self.tlns[number_of_classes]
+
+    def initial_tln_weights(self, number_of_classes, seed=None):
+        return initial_tln_weights(self.tln(number_of_classes), seed=seed)
+
+    def evaluate(self, number_of_classes, learning_rates, tln_weights=None, seeds=None):
+        """
+        :param learning_rates: Online learning rate of every run
+        :param tln_weights: Initial TLN weights of every run, freshly initialized weights if None
+        :param seeds: Seed of every run, of its episode and of its freshly initialized weights. Unseeded if None.
+        :return: test accuracies, train accuracies of every run
+        :rtype: (numpy.ndarray, numpy.ndarray)
+        """
+        if tln_weights is None:
+            tln_weights = [self.initial_tln_weights(number_of_classes, seed=None if seeds is None else seeds[run])
+                           for run in range(len(learning_rates))]
+        return evaluate_classification_mrcl_runs(self.training_data, self.testing_data, None,
+                                                 self.tln(number_of_classes), tln_weights, number_of_classes,
+                                                 learning_rates, self.classification_parameters,
+                                                 max_parallel_runs=self.max_parallel_runs, sparse=self.sparse,
+                                                 sparse_size=self.sparse_size, seeds=seeds)
+
+
 def pre_train(x_pre_train, y_pre_train, rln, tln, learning_rate, classification_parameters):
     with tf.GradientTape() as tape:
         loss, output = compute_loss(x_pre_train, y_pre_train, rln, tln, classification_parameters)
@@ -0,0 +1,182 @@
+import numpy as np
+import tensorflow as tf
+
+
+def synthetic_omniglot(number_of_classes=6, samples_per_class=20):
+    labels = np.random.permutation(np.repeat(np.arange(number_of_classes), samples_per_class))
+    images = np.broadcast_to(labels[:, None, None, None], (len(labels), 84, 84, 1)).astype(np.float32)
+    return tf.data.Dataset.from_tensor_slices({"image": images, "label": labels})
+
+
+def test_get_data_by_classes_groups_samples_by_label():
+    from experiments.exp4_2.omniglot_model import get_background_data_by_classes
+    data, data_15, data_5 = get_background_data_by_classes(synthetic_omniglot())
+    assert data.images.shape == (6, 20, 84, 84, 1)
+    assert data.images.dtype == np.uint8
+    assert len(data_15) == len(data_5) == 6
+    assert data_15.samples_per_class == 15 and data_5.samples_per_class == 5
+    for class_id in range(6):
+        assert (data.labels[class_id] == class_id).all()
+        assert (data.images[class_id] == class_id).all()
+
+
+def test_sampling_from_class_indexed_data():
+    from experiments.exp4_2.omniglot_model import get_background_data_by_classes, partition_into_disjoint, \
+        sample_trajectory, sample_random_10_classes, sample_meta_batch
+    data, _, _ = get_background_data_by_classes(synthetic_omniglot())
+    s_learn, s_remember = partition_into_disjoint(data)
+
+    x_traj, y_traj = sample_trajectory(s_learn, data)
+    assert x_traj.shape == (20, 84, 84, 1) and x_traj.dtype == tf.uint8
+    assert len(set(y_traj.numpy())) == 1 and y_traj[0] in s_learn
+
+    x_rand, y_rand = sample_random_10_classes(s_remember, data)
+    assert x_rand.shape == (10, 84, 84, 1)
+    assert all(y in s_remember for y in y_rand.numpy())
+    assert (x_rand[:, 0, 0, 0].numpy() == y_rand.numpy()).all()
+
+    x_traj, y_traj, x_rand, y_rand = sample_meta_batch(s_learn, s_remember, data, 4)
+    assert x_traj.shape == (4, 20, 84, 84, 1) and y_traj.shape == (4, 20)
+    assert x_rand.shape == (4, 10, 84, 84, 1) and y_rand.shape == (4, 10)
+
+
+def test_get_data_by_classes_keeps_sorted_arrays_memory_mapped(tmpdir):
+    from experiments.exp4_2.omniglot_model import get_data_by_classes
+    labels = np.repeat(np.arange(3), 20)
+    images = np.broadcast_to(labels[:, None, None, None], (60, 84, 84, 1)).astype(np.uint8)
+    np.save(str(tmpdir.join("images.npy")), images)
+    np.save(str(tmpdir.join("labels.npy")), labels)
+    data = get_data_by_classes((np.load(str(tmpdir.join("images.npy")), mmap_mode='r'),
+                                np.load(str(tmpdir.join("labels.npy")), mmap_mode='r')))
+    assert isinstance(data.images, np.memmap)
+    assert data.images.shape == (3, 20, 84, 84, 1)
+    assert (data.images[2] == 2).all()
+
+
+def test_online_training_runs_match_sequential_sgd():
+    from experiments.exp4_2.omniglot_model import online_training_runs, compute_loss
+    from experiments.evaluation import represent
+    from parameters import classification_parameters
+    inputs = tf.keras.Input((12, 12, 1), dtype=tf.uint8)
+    h = tf.keras.layers.Conv2D(4, 3, strides=2, activation='relu')(tf.cast(inputs, tf.float32) / 255.)
+    rln = tf.keras.Model(inputs, tf.keras.layers.Flatten()(h))
+    tln_input = tf.keras.Input(rln.output.shape[-1])
+    tln = tf.keras.Model(tln_input, tf.keras.layers.Dense(5)(tf.keras.layers.Dense(16, activation='relu')(tln_input)))
+
+    x = tf.constant(np.random.randint(0, 255, (2, 30, 12, 12, 1)).astype(np.uint8))
+    y = tf.constant(np.random.randint(0, 5, (2, 30)).astype(np.int32))
+    initial_weights = tln.get_weights()
+    learning_rates = [0.1, 0.01]
+    weights = online_training_runs(represent(x, rln), y,
+                                   [tf.stack([w, w]) for w in initial_weights], tf.constant(learning_rates),
+                                   tln, classification_parameters["loss_function"])
+
+    for run, learning_rate in enumerate(learning_rates):
+        tln.set_weights(initial_weights)
+        optimizer = tf.keras.optimizers.SGD(learning_rate=learning_rate)
+        for m in range(30):
+            with tf.GradientTape() as tape:
+                loss, _ = compute_loss(x[run, m], y[run, m], rln, tln, classification_parameters)
+            optimizer.apply_gradients(zip(tape.gradient(loss, tln.trainable_variables), tln.trainable_variables))
+        for w, expected in zip(weights, tln.get_weights()):
+            np.testing.assert_allclose(w[run].numpy(), expected, atol=1e-5)
+
+
+def test_xla_meta_gradients_match_graph_meta_gradients():
+    from experiments.exp4_2.omniglot_model import meta_gradients_fast_weights, meta_gradients_fast_weights_xla
+    from parameters import classification_parameters
+    inputs = tf.keras.Input((12, 12, 1), dtype=tf.uint8)
+    h = tf.keras.layers.Conv2D(4, 3, strides=2, activation='relu')(tf.cast(inputs, tf.float32) / 255.)
+    rln = tf.keras.Model(inputs, tf.keras.layers.Flatten()(h))
+    tln_input = tf.keras.Input(rln.output.shape[-1])
+    tln = tf.keras.Model(tln_input, tf.keras.layers.Dense(5)(tf.keras.layers.Dense(16, activation='relu')(tln_input)))
+
+    x_traj = tf.constant(np.random.randint(0, 255, (2, 6, 12, 12, 1)).astype(np.uint8))
+    y_traj = tf.constant(np.random.randint(0, 5, (2, 6, 1)).astype(np.int32))
+    x_meta = tf.constant(np.random.randint(0, 255, (2, 9, 12, 12, 1)).astype(np.uint8))
+    y_meta = tf.constant(np.random.randint(0, 5, (2, 9, 1)).astype(np.int32))
+    args = (x_traj, y_traj, x_meta, y_meta, rln, tln, 0.03, classification_parameters["loss_function"])
+    loss, tln_gradients, rln_gradients = meta_gradients_fast_weights(*args)
+    loss_xla, tln_gradients_xla, rln_gradients_xla = meta_gradients_fast_weights_xla()(*args)
+
+    np.testing.assert_allclose(loss_xla.numpy(), loss.numpy(), rtol=1e-5)
+    for g_xla, g in zip(tln_gradients_xla + rln_gradients_xla, tln_gradients + rln_gradients):
+        np.testing.assert_allclose(g_xla.numpy(), g.numpy(), atol=1e-5)
+
+
+def test_sparse_online_training_matches_dense():
+    from experiments.exp4_2.omniglot_model import online_training, online_training_sparse, online_training_runs, \
+        online_training_runs_sparse
+    from experiments.training import compact_sparse
+    from parameters import classification_parameters
+    loss_function = classification_parameters["loss_function"]
+    tln_input = tf.keras.Input(40)
+    tln = tf.keras.Model(tln_input, tf.keras.layers.Dense(5)(tf.keras.layers.Dense(16, activation='relu')(tln_input)))
+
+    x = np.random.rand(2, 30, 40).astype(np.float32)
+    x[np.random.rand(*x.shape) < 0.95] = 0
+    x = tf.constant(x)
+    y = tf.constant(np.random.randint(0, 5, (2, 30)).astype(np.int32))
+    assert compact_sparse(x) is not None
+    assert compact_sparse(tf.ones((2, 30, 40))) is None
+    initial_weights = tln.get_weights()
+
+    online_training(x[0], y[0], tln, tf.constant(0.1), loss_function)
+    dense_weights = tln.get_weights()
+    tln.set_weights(initial_weights)
+    online_training_sparse(*compact_sparse(x[0]), y[0], tln, tf.constant(0.1), loss_function)
+    for w, expected in zip(tln.get_weights(), dense_weights):
+        np.testing.assert_allclose(w, expected, atol=1e-6)
+
+    learning_rates = tf.constant([0.1, 0.01])
+    stacked_weights = [tf.stack([w, w]) for w in initial_weights]
+    dense_weights = online_training_runs(x, y, stacked_weights, learning_rates, tln, loss_function)
+    weights = [tf.Variable(w) for w in stacked_weights]
+    online_training_runs_sparse(*compact_sparse(x), y, weights, learning_rates, tln, loss_function)
+    for w, expected in zip(weights, dense_weights):
+        np.testing.assert_allclose(w.numpy(), expected.numpy(), atol=1e-6)
+
+
+def test_sparse_online_training_is_traced_once_per_number_of_classes():
+    from experiments.exp4_2.omniglot_model import ClassIndexedData, OmniglotEvaluator, online_training_runs_sparse
+    from experiments.training import compact_sparse, compacted_size
+    from parameters import classification_parameters
+    # Every class has another density, so that the episodes have different numbers of nonzero elements
+    density = np.linspace(0.01, 0.1, 8)[:, None, None]
+    representations = np.random.rand(8, 20, 2304).astype(np.float32) * (np.random.rand(8, 20, 2304) < density)
+    labels = np.repeat(np.arange(8)[:, None], 20, axis=1)
+    rln = tf.keras.Sequential([tf.keras.layers.ReLU(input_shape=(2304,))])
+    evaluator = OmniglotEvaluator(ClassIndexedData(representations[:, :15], labels[:, :15]),
+                                  ClassIndexedData(representations[:, 15:], labels[:, 15:]), rln,
+                                  classification_parameters, max_parallel_runs=2, sparse=True)
+    assert evaluator.sparse
+
+    tracing_count = online_training_runs_sparse.experimental_get_tracing_count()
+    for _ in range(3):
+        evaluator.evaluate(3, [0.1, 0.01, 0.001, 0.0001])
+    assert online_training_runs_sparse.experimental_get_tracing_count() == tracing_count + 1
+
+    x = tf.constant(representations[:2, :3])
+    assert compacted_size(x) in (64, 128, 256, 512)
+    assert compact_sparse(x, size=300)[0].shape == (2, 3, 300)
+
+
+def test_seeded_evaluation_runs_are_reproducible():
+    from experiments.exp4_2.omniglot_model import ClassIndexedData, OmniglotEvaluator
+    from parameters import classification_parameters
+    representations = np.random.rand(8, 20, 2304).astype(np.float32)
+    labels = np.repeat(np.arange(8)[:, None], 20, axis=1)
+    rln = tf.keras.Sequential([tf.keras.layers.ReLU(input_shape=(2304,))])
+    evaluator = OmniglotEvaluator(ClassIndexedData(representations[:, :15], labels[:, :15]),
+                                  ClassIndexedData(representations[:, 15:], labels[:, 15:]), rln,
+                                  classification_parameters)
+
+    for w, expected in zip(evaluator.initial_tln_weights(3, seed=1), evaluator.initial_tln_weights(3, seed=1)):
+        np.testing.assert_array_equal(w, expected)
+    assert not np.array_equal(evaluator.initial_tln_weights(3, seed=1)[0], evaluator.initial_tln_weights(3, seed=2)[0])
+
+    first = evaluator.evaluate(3, [0.1, 0.01], seeds=[1, 2])
+    # Every run only depends on its own seed
+    second = evaluator.evaluate(3, [0.01], seeds=[2])
+    np.testing.assert_allclose(second[0], first[0][1:], atol=1e-6)
+    np.testing.assert_allclose(second[1], first[1][1:], atol=1e-6)
@@ -0,0 +1,83 @@
+import numpy as np
+import tensorflow as tf
+
+import pytest
+
+from experiments.evaluation import ModelPool, function_losses, learning_rate_search_isw, evaluate_models_isw, \
+    AsyncEvaluation, trial_seeds
+
+
+def test_model_pool_loads_once_and_restores_saved_weights():
+    loaded = []
+
+    def loader(path):
+        loaded.append(path)
+        return tf.keras.Sequential([tf.keras.layers.Dense(3, input_shape=(2,))])
+
+    models = ModelPool(loader=loader)
+    model = models.get("rln")
+    saved_weights = model.get_weights()
+    model.set_weights([w + 1 for w in saved_weights])
+
+    assert models.get("rln") is model
+    assert loaded == ["rln"]
+    for w, saved in zip(model.get_weights(), saved_weights):
+        np.testing.assert_array_equal(w, saved)
+
+    model.set_weights([w + 1 for w in saved_weights])
+    models.get("rln", reset=False)
+    np.testing.assert_array_equal(model.get_weights()[1], saved_weights[1] + 1)
+    np.testing.assert_array_equal(models.weights("rln")[1], saved_weights[1])
+
+
+def test_async_evaluation_evaluates_a_snapshot_of_the_weights():
+    model = tf.keras.Sequential([tf.keras.layers.Dense(3, input_shape=(2,))])
+    weights = model.get_weights()
+    evaluated = []
+
+    def evaluate(snapshot, step):
+        if step < 0:
+            raise ValueError("Negative step")
+        evaluated.append((step, snapshot.get_weights()))
+
+    evaluation = AsyncEvaluation(evaluate, model)
+    evaluation.submit(0)
+    model.set_weights([w + 1 for w in weights])
+    evaluation.wait()
+    assert evaluated[0][0] == 0
+    for w, expected in zip(evaluated[0][1], weights):
+        np.testing.assert_array_equal(w, expected)
+
+    evaluation.submit(-1)
+    with pytest.raises(ValueError):
+        evaluation.wait()
+
+
+def test_function_losses_match_per_function_losses():
+    tln = tf.keras.Sequential([tf.keras.layers.Dense(1, input_shape=(4,))])
+    loss_function = tf.keras.losses.MeanSquaredError()
+    x = tf.random.normal((3, 5, 4))
+    y = tf.random.normal((3, 5))
+    expected = [loss_function(y[i], tln(x[i])).numpy() for i in range(3)]
+    np.testing.assert_allclose(function_losses(x, y, loss_function, tln).numpy(), expected, rtol=1e-5)
+
+
+def test_learning_rate_search_matches_separate_evaluations():
+    rln = tf.keras.Sequential([tf.keras.layers.Dense(8, activation='relu', input_shape=(3,))])
+    tln = tf.keras.Sequential([tf.keras.layers.Dense(4, activation='relu', input_shape=(8,)), tf.keras.layers.Dense(1)])
+    x_train, y_train = tf.random.normal((2, 16, 3)), tf.random.normal((2, 16))
+    x_val, y_val = tf.random.normal((2, 8, 3)), tf.random.normal((2, 8))
+    initial_weights = tln.get_weights()
+    learning_rates = [0.01, 0.1]
+
+    losses = learning_rate_search_isw(x_train, y_train, x_val, y_val, tln, rln, learning_rates)
+    for loss, learning_rate in zip(losses, learning_rates):
+        tln.set_weights(initial_weights)
+        _, validation_losses = evaluate_models_isw(x_train, y_train, x_val, y_val, tln, rln, learning_rate)
+        np.testing.assert_allclose(loss, validation_losses[0], rtol=1e-5)
+
+
+def test_trial_seeds_exclude_the_learning_rate_search_seed():
+    seeds = trial_seeds(7, 50)
+    assert len(set(seeds)) == 50
+    assert 7 not in seeds
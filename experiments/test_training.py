@@ -0,0 +1,124 @@
+import tensorflow as tf
+import numpy as np
+import pytest
+
+
+def test_functional_forward_matches_tln():
+    from experiments.exp4_2.isw import mrcl_isw
+    from experiments.training import functional_forward
+    rln, tln = mrcl_isw()
+    rep = rln(tf.random.uniform((8, 11)))
+    assert tf.reduce_max(tf.abs(functional_forward(tln, tln.trainable_variables, rep) - tln(rep))) < 1e-5
+
+
+def test_fast_weights_meta_step_matches_assignment():
+    from datasets.synth_datasets import gen_tasks
+    from experiments.exp4_2.isw import mrcl_isw
+    from experiments.training import pretrain_mrcl, prepare_data_pre_training
+    data = prepare_data_pre_training(gen_tasks(20), n_functions=10, sample_length=32, repetitions=1)
+    losses = []
+    for fast_weights in [False, True]:
+        rln, tln = mrcl_isw(seed=0)
+        tln.set_weights([tf.ones_like(w) * 0.01 for w in tln.get_weights()])
+        tln_initial = tf.keras.models.clone_model(tln)
+        meta_optimizer = tf.keras.optimizers.Adam(learning_rate=1e-4)
+        loss = [pretrain_mrcl(*data, tln=tln, tln_initial=tln_initial, rln=rln, meta_optimizer=meta_optimizer,
+                              loss_function=tf.keras.losses.MeanSquaredError(), beta=3e-3,
+                              reset_last_layer=False, fast_weights=fast_weights) for _ in range(2)]
+        losses.append(loss)
+    assert abs(float(losses[0][0]) - float(losses[1][0])) < 1e-4
+    assert abs(float(losses[0][1]) - float(losses[1][1])) < 1e-4
+
+
+def test_compiled_meta_step_matches_eager():
+    from datasets.synth_datasets import gen_tasks
+    from experiments.exp4_2.isw import mrcl_isw
+    from experiments.training import pretrain_mrcl, prepare_data_pre_training
+    data = prepare_data_pre_training(gen_tasks(20), n_functions=10, sample_length=32, repetitions=1)
+    # Random weights, so that a mix-up between hidden units changes the results
+    tln_weights = [np.random.normal(scale=0.1, size=w.shape).astype(np.float32)
+                   for w in mrcl_isw(seed=0)[1].get_weights()]
+    results = []
+    for compiled in [False, True]:
+        rln, tln = mrcl_isw(seed=0)
+        tln.set_weights(tln_weights)
+        tln_initial = tf.keras.models.clone_model(tln)
+        meta_optimizer = tf.keras.optimizers.Adam(learning_rate=1e-4)
+        losses = [float(pretrain_mrcl(*data, tln=tln, tln_initial=tln_initial, rln=rln, meta_optimizer=meta_optimizer,
+                                      loss_function=tf.keras.losses.MeanSquaredError(), beta=3e-3,
+                                      reset_last_layer=False, compiled=compiled)) for _ in range(2)]
+        results.append((losses, tln.get_weights(), rln.get_weights()))
+    (eager_losses, eager_tln, eager_rln), (compiled_losses, compiled_tln, compiled_rln) = results
+    np.testing.assert_allclose(compiled_losses, eager_losses, rtol=1e-5)
+    for w, expected in zip(compiled_tln + compiled_rln, eager_tln + eager_rln):
+        np.testing.assert_allclose(w, expected, atol=1e-6)
+
+
+def test_meta_batch_of_identical_trajectories_matches_single():
+    from datasets.synth_datasets import gen_tasks
+    from experiments.exp4_2.isw import mrcl_isw
+    from experiments.training import pretrain_mrcl, prepare_data_pre_training
+    data = prepare_data_pre_training(gen_tasks(20), n_functions=10, sample_length=32, repetitions=1)
+    meta_batch = [tf.stack([d] * 3) for d in data]
+    results = []
+    for x_traj, y_traj, x_rand, y_rand in [data, meta_batch]:
+        rln, tln = mrcl_isw(seed=0)
+        tln.set_weights([tf.ones_like(w) * 0.01 for w in tln.get_weights()])
+        meta_optimizer = tf.keras.optimizers.SGD(learning_rate=1e-3)
+        loss = pretrain_mrcl(x_traj, y_traj, x_rand, y_rand, tln=tln, tln_initial=None, rln=rln,
+                             meta_optimizer=meta_optimizer, loss_function=tf.keras.losses.MeanSquaredError(),
+                             beta=3e-3, reset_last_layer=False, fast_weights=True)
+        results.append((float(loss), tln.get_weights()[0]))
+    assert abs(results[0][0] - results[1][0]) < 1e-4
+    assert abs(results[0][1] - results[1][1]).max() < 1e-5
+
+
+def test_training_checkpoint_restores_models_optimizer_and_random_state(tmpdir):
+    from experiments.training import training_checkpoint_manager, save_training_checkpoint, \
+        restore_training_checkpoint, wait_for_training_checkpoint
+    model = tf.keras.Sequential([tf.keras.layers.Dense(2, input_shape=(3,))])
+    optimizer = tf.keras.optimizers.Adam()
+    optimizer.apply_gradients(zip([tf.ones_like(v) for v in model.trainable_variables], model.trainable_variables))
+    manager = training_checkpoint_manager(str(tmpdir), model=model, optimizer=optimizer)
+    save_training_checkpoint(manager, 41)
+    wait_for_training_checkpoint(manager)
+    expected_draw = np.random.rand()
+    saved_weights = model.get_weights()
+
+    restored_model = tf.keras.Sequential([tf.keras.layers.Dense(2, input_shape=(3,))])
+    restored_optimizer = tf.keras.optimizers.Adam()
+    manager = training_checkpoint_manager(str(tmpdir), model=restored_model, optimizer=restored_optimizer)
+    assert restore_training_checkpoint(manager) == 42
+    assert np.random.rand() == expected_draw
+    assert restored_optimizer.iterations.numpy() == 1
+    for w, saved in zip(restored_model.get_weights(), saved_weights):
+        np.testing.assert_array_equal(w, saved)
+
+
+def test_weight_checkpoints_keep_the_latest_and_load_as_float32(tmpdir):
+    from experiments.training import WeightCheckpoints, load_weights
+    model = tf.keras.Sequential([tf.keras.layers.Dense(2, input_shape=(3,))])
+    checkpoints = WeightCheckpoints("mrcl", directory=str(tmpdir), keep=2, float16=True)
+    for epoch in [100, 200, 300]:
+        checkpoints.save(epoch, rln=model, tln=model)
+    assert checkpoints.epochs() == [200, 300]
+
+    weights = load_weights(checkpoints.path(300))
+    assert set(weights) == {"rln", "tln"}
+    for w, saved in zip(weights["tln"], model.get_weights()):
+        assert w.dtype == np.float32
+        np.testing.assert_allclose(w, saved, atol=1e-3)
+
+    with pytest.raises(ValueError):
+        WeightCheckpoints("mrcl", directory=str(tmpdir), keep=0)
+
+
+def test_dtype_policy_is_restored():
+    from experiments.training import dtype_policy
+    with pytest.raises(RuntimeError):
+        with dtype_policy("mixed_bfloat16"):
+            model = tf.keras.Sequential([tf.keras.layers.Dense(2, input_shape=(3,))])
+            raise RuntimeError
+    assert model.layers[0].compute_dtype == "bfloat16"
+    assert tf.keras.mixed_precision.global_policy().name == "float32"
+    assert tf.keras.layers.Dense(2).compute_dtype == "float32"
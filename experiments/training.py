@@ -1,32 +1,186 @@
 import tensorflow as tf
 
-from os import makedirs
-from os.path import isdir
+import contextlib
+import glob
+import math
+import os
 
-from datasets.synth_datasets import gen_sine_data
+from datasets.synth_datasets import gen_sine_data, sine_data_stream
+from util.profiling import no_timer
 import numpy as np
 
 
+@contextlib.contextmanager
+def dtype_policy(name):
+    """
+    Set the global Keras dtype policy, e.g. "mixed_bfloat16", only for the enclosed code. Layers take the policy when
+    they are created, so models built inside keep it while models built afterwards get the previous policy again.
+    :param name: Policy name, the current policy is kept if None
+    """
+    if name is None:
+        # The mixed precision API is only touched when a policy is requested, older TensorFlow versions lack it
+        yield
+        return
+    previous = tf.keras.mixed_precision.global_policy()
+    tf.keras.mixed_precision.set_global_policy(name)
+    try:
+        yield
+    finally:
+        tf.keras.mixed_precision.set_global_policy(previous)
+
+
 def copy_parameters(source, dest):
     for s, d in zip(source.trainable_variables, dest.trainable_variables):
         d.assign(s)
 
 
-def save_models(epoch, rln, tln):
-    try:
-        isdir("saved_models/")
-    except NotADirectoryError:
-        makedirs("save_models")
-    rln.save(f"saved_models/rln_pretraining_{epoch}.tf", save_format="tf")
-    tln.save(f"saved_models/tln_pretraining_{epoch}.tf", save_format="tf")
+def save_models(model, name):
+    """
+    Export a full SavedModel, meant for the end of training. Periodic checkpoints are cheaper with WeightCheckpoints.
+    """
+    os.makedirs("saved_models", exist_ok=True)
+    model.save(f"saved_models/{name}.tf", save_format="tf")
 
 
-def save_models(model, name):
+class WeightCheckpoints:
+    """
+    Periodic checkpoints holding only the weight arrays of models, in one .npz file per epoch named
+    {directory}/{name}_{epoch}.npz. Only the most recent ones are kept.
+    """
+    def __init__(self, name, directory="saved_models", keep=None, float16=False):
+        """
+        :param name: Prefix of the checkpoint files
+        :param keep: Number of most recent checkpoints kept, at least 1, all of them if None
+        :param float16: Store floating point weights as float16, halving the size of the checkpoints
+        """
+        if keep is not None and keep < 1:
+            raise ValueError(f"keep must be at least 1 or None, got {keep}")
+        self.name = name
+        self.directory = directory
+        self.keep = keep
+        self.float16 = float16
+
+    def path(self, epoch):
+        return os.path.join(self.directory, f"{self.name}_{epoch}.npz")
+
+    def epochs(self):
+        """
+        Epochs of the checkpoints on disk, in increasing order
+        """
+        epochs = []
+        for path in glob.glob(os.path.join(self.directory, f"{self.name}_*.npz")):
+            epoch = os.path.basename(path)[len(self.name) + 1:-len(".npz")]
+            if epoch.isdigit():
+                epochs.append(int(epoch))
+        return sorted(epochs)
+
+    def save(self, epoch, **models):
+        """
+        :param models: Models to save by name, e.g. rln=rln, tln=tln
+        """
+        arrays = {}
+        for model_name, model in models.items():
+            for i, w in enumerate(model.get_weights()):
+                if self.float16 and np.issubdtype(w.dtype, np.floating):
+                    w = w.astype(np.float16)
+                arrays[f"{model_name}/{i}"] = w
+
+        os.makedirs(self.directory, exist_ok=True)
+        # Write to a temporary file first so that readers never see a partial checkpoint
+        path = self.path(epoch)
+        with open(path + ".tmp", "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(path + ".tmp", path)
+
+        if self.keep is not None:
+            for old_epoch in self.epochs()[:-self.keep]:
+                os.remove(self.path(old_epoch))
+
+
+def load_weights(path):
+    """
+    Load a checkpoint written by WeightCheckpoints
+    :return: Weights of every saved model by name, in float32 if they were stored as float16
+    :rtype: dict
+    """
+    weights = {}
+    with np.load(path) as arrays:
+        for key in sorted(arrays.files, key=lambda k: (k.rsplit("/", 1)[0], int(k.rsplit("/", 1)[1]))):
+            w = arrays[key]
+            weights.setdefault(key.rsplit("/", 1)[0], []).append(w.astype(np.float32) if w.dtype == np.float16 else w)
+    return weights
+
+
+class NumpyRandomState(tf.Module):
+    """
+    State of NumPy's global random generator held in variables, so that it can be saved in a tf.train.Checkpoint
+    """
+    def __init__(self):
+        super().__init__()
+        self.keys = tf.Variable(tf.zeros(624, dtype=tf.int64))
+        self.position = tf.Variable(0, dtype=tf.int64)
+
+    def capture(self):
+        _, keys, position, _, _ = np.random.get_state()
+        self.keys.assign(keys.astype(np.int64))
+        self.position.assign(position)
+
+    def apply(self):
+        np.random.set_state(("MT19937", self.keys.numpy().astype(np.uint32), int(self.position.numpy())))
+
+
+def training_checkpoint_manager(directory, max_to_keep=3, **state):
+    """
+    Manager of checkpoints of the whole training state: the given trackable objects (models, optimizer, ...), the
+    epoch and the global NumPy random state
+    :param directory: Directory of the checkpoints
+    :param max_to_keep: Number of most recent checkpoints kept
+    :param state: Trackable objects to save, e.g. rln=rln, tln=tln, meta_optimizer=meta_optimizer
+    :rtype: tf.train.CheckpointManager
+    """
+    checkpoint = tf.train.Checkpoint(epoch=tf.Variable(-1, dtype=tf.int64), numpy_random_state=NumpyRandomState(),
+                                     **state)
+    return tf.train.CheckpointManager(checkpoint, directory, max_to_keep=max_to_keep)
+
+
+def save_training_checkpoint(manager, epoch):
+    """
+    Save the training state after the given epoch. Writes run in the background where TensorFlow supports it.
+    """
+    checkpoint = manager.checkpoint
+    checkpoint.epoch.assign(epoch)
+    checkpoint.numpy_random_state.capture()
     try:
-        isdir("saved_models/")
-    except NotADirectoryError:
-        makedirs("saved_models/")
-    model.save(f"saved_models/{name}.tf", save_format="tf")
+        options = tf.train.CheckpointOptions(experimental_enable_async_checkpoint=True)
+    except (AttributeError, TypeError):
+        options = None
+    if options is None:
+        manager.save(checkpoint_number=epoch)
+    else:
+        manager.save(checkpoint_number=epoch, options=options)
+
+
+def restore_training_checkpoint(manager):
+    """
+    Restore the training state from the latest checkpoint, if there is one
+    :return: Epoch to continue training from
+    :rtype: int
+    """
+    if manager.latest_checkpoint is None:
+        return 0
+    checkpoint = manager.checkpoint
+    checkpoint.restore(manager.latest_checkpoint)
+    checkpoint.numpy_random_state.apply()
+    print(f"Restored {manager.latest_checkpoint}")
+    return int(checkpoint.epoch.numpy()) + 1
+
+
+def wait_for_training_checkpoint(manager):
+    """
+    Block until checkpoint writes running in the background are finished
+    """
+    if hasattr(manager.checkpoint, "sync"):
+        manager.checkpoint.sync()
 
 
 @tf.function
@@ -46,8 +200,173 @@ def compute_loss(x, y, tln, rln, loss_fun):
     return loss
 
 
+def functional_forward(model, weights, x):
+    """
+    Forward pass through a stack of Dense layers (e.g. the TLN) that uses an explicit list of weight tensors instead
+    of the layers' variables, so that updated (fast) weights can be used without assigning them to the model
+    :param model: Model whose layers define the activations
+    :param weights: Weight tensors ordered as model.trainable_variables ([kernel, bias] per layer)
+    :param x: Input tensor
+    :return: Output tensor
+    """
+    h = x
+    layers = [layer for layer in model.layers if layer.trainable_weights]
+    for layer, kernel, bias in zip(layers, weights[::2], weights[1::2]):
+        # Compute in the layer's dtype like the layer itself would, e.g. bfloat16 under a mixed precision policy
+        h, kernel, bias = [tf.cast(t, layer.compute_dtype) for t in (h, kernel, bias)]
+        # Biases are broadcast over the samples, which also covers weights stacked over a meta-batch
+        h = layer.activation(tf.matmul(h, kernel) + tf.expand_dims(bias, axis=-2))
+    return h
+
+
+def compacted_size(x, max_density=0.25, round_up=True):
+    """
+    Number of elements k of every representation compacted by compact_sparse: the largest number of nonzero elements
+    of a representation
+    :param x: Representations, the last axis is compacted
+    :param max_density: Largest number of nonzero elements of a representation as a fraction of the representation
+                        size, denser representations are faster with the dense products of functional_forward
+    :param round_up: Round k up to a power of two, so that compiled functions are traced for a few sizes only
+    :return: k, at most max_density times the representation size, or None if the representations are too dense
+    """
+    nonzero = max(1, int(tf.reduce_max(tf.math.count_nonzero(x, axis=-1))))
+    if nonzero > max_density * x.shape[-1]:
+        return None
+    if not round_up:
+        return nonzero
+    return min(2 ** math.ceil(math.log2(nonzero)), int(max_density * x.shape[-1]))
+
+
+def compact_sparse(x, max_density=0.25, size=None):
+    """
+    Gather-compaction of sparse representations (e.g. RLN outputs after a ReLU) for sparse_functional_forward: the
+    indices and values of the nonzero elements of every representation, padded with zeros to k elements
+    :param x: Representations, the last axis is compacted
+    :param max_density: See compacted_size
+    :param size: k, e.g. the compacted_size of all the data so that every batch has the same shapes. The
+                 compacted_size of x if None.
+    :return: Indices and values of shape x.shape[:-1] + (k,), or None if the representations are too dense
+    """
+    nonzero = int(tf.reduce_max(tf.math.count_nonzero(x, axis=-1)))
+    if nonzero > max_density * x.shape[-1]:
+        return None
+    if size is None:
+        size = compacted_size(x, max_density)
+    elif nonzero > size:
+        raise ValueError(f"Representations with {nonzero} nonzero elements don't fit in {size} elements")
+    # The nonzero elements come first among the top k of the indicator, the padding takes zero elements
+    _, indices = tf.math.top_k(tf.cast(tf.not_equal(x, 0), tf.float32), k=size)
+    return indices, tf.gather(x, indices, batch_dims=len(x.shape) - 1)
+
+
+def sparse_functional_forward(model, weights, values):
+    """
+    functional_forward of representations compacted by compact_sparse. Only the rows of the first kernel that belong
+    to the nonzero inputs are used, so the gradient of the first kernel is nonzero only in these rows.
+    :param weights: Weight tensors ordered as model.trainable_variables, except that the first kernel is replaced by
+                    its rows gathered at the indices of the compacted inputs, of shape values.shape + (units,)
+    :param values: Values of the compacted inputs
+    :return: Output tensor
+    """
+    layers = [layer for layer in model.layers if layer.trainable_weights]
+    rows, bias = [tf.cast(t, layers[0].compute_dtype) for t in weights[:2]]
+    values = tf.cast(values, layers[0].compute_dtype)
+    # Sparse-dense product of every input with the kernel rows of its nonzero elements
+    h = tf.squeeze(tf.matmul(tf.expand_dims(values, axis=-2), rows), axis=-2)
+    h = layers[0].activation(h + tf.expand_dims(bias, axis=-2))
+    for layer, kernel, bias in zip(layers[1:], weights[2::2], weights[3::2]):
+        h, kernel, bias = [tf.cast(t, layer.compute_dtype) for t in (h, kernel, bias)]
+        h = layer.activation(tf.matmul(h, kernel) + tf.expand_dims(bias, axis=-2))
+    return h
+
+
+def stack_weights(variables, n):
+    """
+    Stack n copies of the given variables along a new leading axis, e.g. one set of fast weights per task
+    """
+    return [tf.tile(tf.expand_dims(v, axis=0), [n] + [1] * v.shape.ndims) for v in variables]
+
+
+def fast_weights_update(x, y, weights, tln, beta, loss_fun):
+    with tf.GradientTape(watch_accessed_variables=False) as Wj_Tape:
+        Wj_Tape.watch(weights)
+        inner_loss = loss_fun(functional_forward(tln, weights, x), y)
+    gradients = Wj_Tape.gradient(inner_loss, weights)
+    return [w - beta * g for w, g in zip(weights, gradients)]
+
+
+@tf.function
+def meta_gradients(x_traj, y_traj, x_rand, y_rand, tln, tln_initial, rln, loss_function, beta):
+    """
+    Compiled inner loop and outer gradients of an MRCL meta-update. The inner loop runs as a graph loop and the
+    outer gradients of both the TLN and the RLN come from a single tape call.
+    :return: outer loss, gradients w.r.t. the TLN and RLN weights
+    """
+    # Save actual values for later retrieval
+    copy_parameters(tln, tln_initial)
+
+    x_meta = tf.concat([x_rand, tf.reshape(x_traj, [-1, x_traj.shape[-1]])], axis=0)
+    y_meta = tf.concat([y_rand, tf.reshape(y_traj, [-1])], axis=0)
+
+    # The RLN is not updated in the inner loop, so the representations of the
+    # whole trajectory are computed once in a single batched pass
+    rep_traj = rln(tf.reshape(x_traj, [-1, x_traj.shape[-1]]))
+    rep_traj = tf.reshape(rep_traj, [tf.shape(x_traj)[0], tf.shape(x_traj)[1], -1])
+
+    for i in tf.range(tf.shape(x_traj)[0]):
+        with tf.GradientTape(watch_accessed_variables=False) as Wj_Tape:
+            Wj_Tape.watch(tln.trainable_variables)
+            inner_loss = loss_function(tln(rep_traj[i]), y_traj[i])
+        gradients = Wj_Tape.gradient(inner_loss, tln.trainable_variables)
+        for g, v in zip(gradients, tln.trainable_variables):
+            v.assign(v - beta * g)
+
+    with tf.GradientTape() as theta_Tape:
+        outer_loss = compute_loss(x=x_meta, y=y_meta, tln=tln, rln=rln, loss_fun=loss_function)
+
+    gradients = theta_Tape.gradient(outer_loss, tln.trainable_variables + rln.trainable_variables)
+    return outer_loss, gradients
+
+
+@tf.function
+def meta_gradients_fast_weights(x_traj, y_traj, x_rand, y_rand, tln, rln, loss_function, beta):
+    """
+    Compiled inner loop and outer gradients of an MRCL meta-update with fast weights. The inner loop only updates
+    tensors, so the TLN variables keep their initial values and no copy of them is needed. As in the other
+    meta-updates, the outer gradient w.r.t. the adapted TLN weights is the one applied to the initial weights.
+    All inputs have a leading meta-batch axis: the inner loops of the trajectories run in parallel on stacked fast
+    weights and their outer gradients are averaged.
+    :return: outer loss, gradients w.r.t. the TLN and RLN weights
+    """
+    n_tasks = x_traj.shape[0]
+    n_features = x_traj.shape[-1]
+    x_meta = tf.concat([x_rand, tf.reshape(x_traj, [n_tasks, -1, n_features])], axis=1)
+    y_meta = tf.concat([y_rand, tf.reshape(y_traj, [n_tasks, -1])], axis=1)
+
+    rep_traj = rln(tf.reshape(x_traj, [-1, n_features]))
+    rep_traj = tf.reshape(rep_traj, tf.concat([tf.shape(x_traj)[:3], [-1]], axis=0))
+
+    # The loss is averaged over the tasks, scaling it back keeps each task's inner gradient independent of the others
+    def inner_loss_function(output, y):
+        return n_tasks * loss_function(output, y)
+
+    weights = stack_weights(tln.trainable_variables, n_tasks)
+    for i in tf.range(tf.shape(x_traj)[1]):
+        weights = fast_weights_update(rep_traj[:, i], y_traj[:, i], weights, tln, beta, inner_loss_function)
+
+    with tf.GradientTape() as theta_Tape:
+        theta_Tape.watch(weights)
+        rep_meta = tf.reshape(rln(tf.reshape(x_meta, [-1, n_features])), [n_tasks, x_meta.shape[1], -1])
+        outer_loss = loss_function(functional_forward(tln, weights, rep_meta), y_meta)
+
+    gradients = theta_Tape.gradient(outer_loss, weights + rln.trainable_variables)
+    # Summing the stacked gradients of the mean outer loss averages the per-task gradients
+    tln_gradients = [tf.reduce_sum(g, axis=0) for g in gradients[:len(weights)]]
+    return outer_loss, tln_gradients + gradients[len(weights):]
+
+
 def pretrain_mrcl(x_traj, y_traj, x_rand, y_rand, tln, tln_initial, rln, meta_optimizer, loss_function, beta,
-                  reset_last_layer=True):
+                  reset_last_layer=True, compiled=False, fast_weights=False, timer=no_timer):
     if reset_last_layer:
         # Random reinitialization of last layer
         last_layer = tln.layers[-1]
@@ -62,8 +381,36 @@ def pretrain_mrcl(x_traj, y_traj, x_rand, y_rand, tln, tln_initial, rln, meta_op
         w.assign(new_w)
         b.assign(new_b)
 
+    # The compiled meta-updates leave applying the gradients to the optimizer, outside of the graph, so that its
+    # slots can be created on any call
+    if fast_weights:
+        if x_traj.shape.ndims == 3:
+            # Single trajectory, add the meta-batch axis
+            x_traj, y_traj, x_rand, y_rand = [tf.expand_dims(t, axis=0) for t in (x_traj, y_traj, x_rand, y_rand)]
+        with timer.phase("meta_gradients"):
+            outer_loss, gradients = meta_gradients_fast_weights(x_traj=x_traj, y_traj=y_traj, x_rand=x_rand,
+                                                                y_rand=y_rand, tln=tln, rln=rln,
+                                                                loss_function=loss_function, beta=beta)
+        with timer.phase("optimizer"):
+            meta_optimizer.apply_gradients(zip(gradients, tln.trainable_variables + rln.trainable_variables))
+        return outer_loss
+
+    if compiled:
+        with timer.phase("meta_gradients"):
+            outer_loss, gradients = meta_gradients(x_traj=x_traj, y_traj=y_traj, x_rand=x_rand, y_rand=y_rand,
+                                                   tln=tln, tln_initial=tln_initial, rln=rln,
+                                                   loss_function=loss_function, beta=beta)
+        with timer.phase("optimizer"):
+            meta_optimizer.apply_gradients(zip(gradients, tln_initial.trainable_variables + rln.trainable_variables))
+
+        # Retrieve updated tln parameters
+        with timer.phase("copies"):
+            copy_parameters(tln_initial, tln)
+        return outer_loss
+
     # Save actual values for later retrieval
-    copy_parameters(tln, tln_initial)
+    with timer.phase("copies"):
+        copy_parameters(tln, tln_initial)
 
     # Sample x_rand, y_rand from s_remember
     x_traj_f = tf.concat([i for i in x_traj], 0)
@@ -72,36 +419,58 @@ def pretrain_mrcl(x_traj, y_traj, x_rand, y_rand, tln, tln_initial, rln, meta_op
     x_meta = tf.concat([x_rand, x_traj_f], axis=0)
     y_meta = tf.concat([y_rand, y_traj_f], axis=0)
 
-    for x, y in tf.data.Dataset.from_tensor_slices((x_traj, y_traj)):
-        inner_update(x=x, y=y, tln=tln, rln=rln, beta=beta,
-                     loss_fun=loss_function)
+    with timer.phase("inner_loop"):
+        for x, y in tf.data.Dataset.from_tensor_slices((x_traj, y_traj)):
+            inner_update(x=x, y=y, tln=tln, rln=rln, beta=beta,
+                         loss_fun=loss_function)
 
-    with tf.GradientTape(persistent=True) as theta_Tape:
-        outer_loss = compute_loss(x=x_meta, y=y_meta, tln=tln, rln=rln, loss_fun=loss_function)
+    with timer.phase("outer_gradient"):
+        with tf.GradientTape(persistent=True) as theta_Tape:
+            outer_loss = compute_loss(x=x_meta, y=y_meta, tln=tln, rln=rln, loss_fun=loss_function)
 
-    tln_gradients = theta_Tape.gradient(outer_loss, tln.trainable_variables)
-    rln_gradients = theta_Tape.gradient(outer_loss, rln.trainable_variables)
-    del theta_Tape
-    meta_optimizer.apply_gradients(zip(tln_gradients + rln_gradients,
-                                       tln_initial.trainable_variables + rln.trainable_variables))
+        tln_gradients = theta_Tape.gradient(outer_loss, tln.trainable_variables)
+        rln_gradients = theta_Tape.gradient(outer_loss, rln.trainable_variables)
+        del theta_Tape
+    with timer.phase("optimizer"):
+        meta_optimizer.apply_gradients(zip(tln_gradients + rln_gradients,
+                                           tln_initial.trainable_variables + rln.trainable_variables))
 
     # Retrieve updated tln parameters
-    copy_parameters(tln_initial, tln)
+    with timer.phase("copies"):
+        copy_parameters(tln_initial, tln)
 
     return outer_loss
 
-def prepare_data_pre_training(tasks, n_functions, sample_length, repetitions):
+
+def reshape_pre_training_data(x_traj, y_traj, x_rand, y_rand):
+    """
+    Merge the function axis of generated sine waves into the trajectory (x_traj, y_traj) and sample (x_rand, y_rand)
+    axes used for pre training
+    """
+    sample_length, n_features = x_traj.shape[-2:]
+    x_traj = x_traj.reshape(-1, sample_length, n_features).astype(np.float32)
+    y_traj = y_traj.reshape(-1, sample_length).astype(np.float32)
+    x_rand = x_rand.reshape(-1, n_features).astype(np.float32)
+    y_rand = y_rand.reshape(-1).astype(np.float32)
+    return x_traj, y_traj, x_rand, y_rand
+
+
+def prepare_data_pre_training(tasks, n_functions, sample_length, repetitions, meta_batch_size=None, rng=None):
+    if meta_batch_size is not None:
+        # Stack independently sampled episodes along a leading meta-batch axis
+        episodes = [prepare_data_pre_training(tasks, n_functions, sample_length, repetitions, rng=rng)
+                    for _ in range(meta_batch_size)]
+        return tuple(tf.stack(data) for data in zip(*episodes))
+
     # Sample data
-    x_traj, y_traj, x_rand, y_rand = gen_sine_data(tasks=tasks,
-                                                   n_functions=n_functions,
-                                                   sample_length=sample_length,
-                                                   repetitions=repetitions)
+    data = gen_sine_data(tasks=tasks,
+                         n_functions=n_functions,
+                         sample_length=sample_length,
+                         repetitions=repetitions,
+                         rng=rng)
 
     # Reshape for inputting to training method
-    x_traj = np.vstack(x_traj)
-    y_traj = np.vstack(y_traj)
-    x_rand = np.vstack(x_rand)
-    y_rand = np.hstack(y_rand)
+    x_traj, y_traj, x_rand, y_rand = reshape_pre_training_data(*data)
 
     # Numpy -> Tensorflow
     x_rand = tf.convert_to_tensor(x_rand, dtype=tf.float32)
@@ -112,18 +481,52 @@ def prepare_data_pre_training(tasks, n_functions, sample_length, repetitions):
     return x_traj, y_traj, x_rand, y_rand
 
 
+def pre_training_episodes(tasks, n_functions, sample_length, repetitions, n_ids=10, meta_batch_size=None,
+                          iid=False, prefetch=2, seed=None):
+    """
+    Endless tf.data stream of pre training episodes, each one as returned by prepare_data_pre_training. Episodes are
+    generated in the background while the consumer trains on the previous ones.
+    :param meta_batch_size: If given, episodes are batched along a leading meta-batch axis
+    :param iid: Shuffle the trajectory samples of every episode with to_iid
+    :param prefetch: Number of episodes prepared ahead of the consumer
+    :param seed: Seed of the random generator of the stream
+    :rtype: tf.data.Dataset
+    """
+    def episodes():
+        stream = sine_data_stream(tasks, n_functions, sample_length, repetitions, n_ids,
+                                  rng=np.random.default_rng(seed))
+        for data in stream:
+            yield reshape_pre_training_data(*data)
+
+    n_trajectories = n_functions * repetitions
+    n_features = n_ids + 1
+    dataset = tf.data.Dataset.from_generator(episodes,
+                                             output_types=(tf.float32,) * 4,
+                                             output_shapes=((n_trajectories, sample_length, n_features),
+                                                            (n_trajectories, sample_length),
+                                                            (n_functions * sample_length, n_features),
+                                                            (n_functions * sample_length,)))
+    if iid:
+        dataset = dataset.map(lambda x_traj, y_traj, x_rand, y_rand:
+                              to_iid(x_traj, y_traj, n_functions, sample_length, repetitions) + (x_rand, y_rand),
+                              num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    if meta_batch_size is not None:
+        dataset = dataset.batch(meta_batch_size)
+    return dataset.prefetch(prefetch)
+
+
 def to_iid(x1, y1, n_functions, sample_length, repetitions):
     # Reshape to 2D
-    x1_t = tf.reshape(x1, [-1, n_functions + 1])
+    x1_t = tf.reshape(x1, [-1, x1.shape[-1]])
     y1_t = tf.reshape(y1, [-1,])
 
-    indexes = np.random.permutation(len(x1_t))
+    indexes = tf.random.shuffle(tf.range(tf.shape(x1_t)[0]))
 
     x1_t = tf.gather(x1_t, indexes)
     y1_t = tf.gather(y1_t, indexes)
 
     # Reshape back
-    x1 = tf.reshape(x1_t, [10 * repetitions, sample_length, n_functions + 1])
-    y1 = tf.reshape(y1_t, [10 * repetitions, sample_length])
+    x1 = tf.reshape(x1_t, [n_functions * repetitions, sample_length, x1.shape[-1]])
+    y1 = tf.reshape(y1_t, [n_functions * repetitions, sample_length])
 
     return x1, y1
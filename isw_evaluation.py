@@ -7,9 +7,33 @@ import json
 
 from datasets.synth_datasets import gen_sine_data, gen_tasks
 from experiments.evaluation import train_and_evaluate, prepare_data_evaluation
-from experiments.evaluation import evaluate_models_isw
+from experiments.evaluation import evaluate_models_isw, ModelPool
+from experiments.evaluation import learning_rate_search_isw, trial_seeds
+from experiments.exp4_2.isw import mrcl_isw_from_weights
+from experiments.training import load_weights
+from util.results_store import ResultsStore
 
 import argparse
+import functools
+import multiprocessing
+
+def load_model(path):
+    """
+    Load a SavedModel, or a model of a weight checkpoint written by
+    WeightCheckpoints given as {checkpoint}.npz:{model}, e.g.
+    saved_models/isw_mrcl_100.npz:rln
+    """
+    if ".npz:" not in path:
+        return tf.keras.models.load_model(path)
+    checkpoint, model = path.rsplit(":", 1)
+    weights = load_weights(checkpoint)
+    rln, tln = mrcl_isw_from_weights(weights["rln"], weights["tln"])
+    return {"rln": rln, "tln": tln}[model]
+
+
+# Checkpoints are loaded once per process and the models are reset to their
+# saved weights for every run
+models = ModelPool(loader=load_model)
 
 
 def parse_args():
@@ -32,29 +56,111 @@ def parse_args():
                                       "number of random trajectories")
     argument_parser.add_argument("--model_file_rln", default="saved_models/"
                                  "pt_lr1e-07_rln5_tln3_rln.tf", type=str,
-                                 help="Model file for the rln")
+                                 help="Model file for the rln, a SavedModel "
+                                      "or {checkpoint}.npz:rln")
     argument_parser.add_argument("--model_file_tln", default="saved_models/"
                                  "pt_lr1e-07_rln5_tln3_tln.tf", type=str,
-                                 help="Model file for the tln")
+                                 help="Model file for the tln, a SavedModel "
+                                      "or {checkpoint}.npz:tln")
     argument_parser.add_argument("--learning_rate", nargs="+",
                                  default=[0.003, 0.01, 0.03, 0.1, 0.3], type=float,
                                  help="Learning rate(s) to try")
     argument_parser.add_argument("--results_dir",
                                  default="./results/{}/", type=str,
                                  help="Evaluation results file")
+    argument_parser.add_argument("--results_db",
+                                 default="results/results.db", type=str,
+                                 help="Results store that every trial is "
+                                      "appended to and resumed from")
     argument_parser.add_argument("--resetting_last_layer", action='store_true',
                                  help="Reinitialization of the last"
                                       "layer of the TLN")
     argument_parser.add_argument("--seed", default=0, type=int,
-                                 help="Seed for the random functions")
+                                 help="Seed for the random functions. Test "
+                                      "trial i uses seed + i")
+    argument_parser.add_argument("--workers", default=1, type=int,
+                                 help="Number of processes running test "
+                                      "trials in parallel")
+    argument_parser.add_argument("--threads_per_worker", default=None,
+                                 type=int,
+                                 help="TensorFlow threads of every worker, by "
+                                      "default the cores are split evenly")
 
     args = argument_parser.parse_args()
     return args
 
 
+def init_worker(threads):
+    """
+    Pin the TensorFlow thread pools of a trial worker process
+    """
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+
+
+def run_trial(args, tasks, learning_rate, seed):
+    """
+    One evaluation trial on freshly generated data
+    :return: mean loss, loss per class during training (3a) and
+             interference losses (3b) on the training data
+    """
+    # Continual Regression Experiment (Figure 3)
+    data = prepare_data_evaluation(tasks,
+                                   args.n_functions,
+                                   args.sample_length,
+                                   args.repetitions,
+                                   seed=seed)
+
+    x_train, y_train, x_val, y_val = data
+
+    rln = models.get(args.model_file_rln)
+    tln = models.get(args.model_file_tln)
+
+    # Random reinitialization of last layer
+    if args.resetting_last_layer:
+        w = tln.layers[-1].weights[0]
+        b = tln.layers[-1].weights[1]
+        new_w = tf.keras.initializers.he_normal(seed=seed)(shape=w.shape)
+        w.assign(new_w)
+        new_b = tf.keras.initializers.zeros()(shape=b.shape)
+        b.assign(new_b)
+
+    losses = evaluate_models_isw(x_train=x_train,
+                                 y_train=y_train,
+                                 x_val=x_val,
+                                 y_val=y_val,
+                                 rln=rln,
+                                 tln=tln,
+                                 batch_size=args.batch_size_evaluation,
+                                 epochs=1,
+                                 learning_rate=learning_rate)
+
+    training_losses, validation_losses = losses
+
+    # For now, we will care only on training losses
+    return training_losses
+
+
+def store_trial(store, args, learning_rate, seed, losses):
+    mean_loss_all, loss_per_class_during_training, interference_losses = losses
+    store.append(args.model_name, "isw", args.n_functions, learning_rate, seed,
+                 loss=mean_loss_all, **{"3a": loss_per_class_during_training,
+                                        "3b": interference_losses})
+
+
 def main(args):
+    # Stored trials are only resumed with the same checkpoints and data, the
+    # seed also determines the tasks
+    store = ResultsStore(args.results_db)
+    store.check_config(args.model_name, "isw",
+                       {key: getattr(args, key) for key in
+                        ["model_file_rln", "model_file_tln", "n_functions",
+                         "sample_length", "repetitions",
+                         "batch_size_evaluation", "resetting_last_layer",
+                         "seed"]})
+
     # Generate tasks parameters
-    tasks = gen_tasks(args.n_functions)
+    tasks = gen_tasks(args.n_functions, rng=np.random.default_rng(args.seed))
     test_tasks = gen_tasks(args.n_tasks)
 
     # Create logs directories
@@ -83,33 +189,25 @@ def main(args):
                                                                  args.repetitions,
                                                                  seed=args.seed)
 
-        tf.keras.backend.clear_session()
-        rln = tf.keras.models.load_model(args.model_file_rln)
-        tln = tf.keras.models.load_model(args.model_file_tln)
+        rln = models.get(args.model_file_rln)
+        tln = models.get(args.model_file_tln)
 
         # Random reinitialization of last layer
         if args.resetting_last_layer:
             w = tln.layers[-1].weights[0]
             b = tln.layers[-1].weights[1]
-            new_w = tf.keras.initializers.he_normal()(shape=w.shape)
-            new_b = tf.keras.initializers.zeros()(shape=b.shape)
-
-        for lr in tqdm.tqdm(learning_rate):
-            if args.resetting_last_layer:
-                w.assign(new_w)
-                b.assign(new_b)
-            # Numpy -> Tensorflow
-            losses = evaluate_models_isw(x_train=x_train,
-                                         y_train=y_train,
-                                         x_val=x_val,
-                                         y_val=y_val,
-                                         tln=tln, rln=rln,
-                                         learning_rate=lr)
-            training_losses, validation_losses = losses
-
-            mean_loss_all_val = validation_losses[0]
-
-            loss_per_lr.append((lr, mean_loss_all_val))
+            w.assign(tf.keras.initializers.he_normal(seed=args.seed)(shape=w.shape))
+            b.assign(tf.keras.initializers.zeros()(shape=b.shape))
+
+        # All learning rates are trained at once, from the same starting weights
+        mean_losses_val = learning_rate_search_isw(x_train=x_train,
+                                                   y_train=y_train,
+                                                   x_val=x_val,
+                                                   y_val=y_val,
+                                                   tln=tln, rln=rln,
+                                                   learning_rates=learning_rate,
+                                                   batch_size=args.batch_size_evaluation)
+        loss_per_lr = list(zip(learning_rate, mean_losses_val))
 
         best_lr, best_loss = sorted(loss_per_lr, key=lambda x: x[1])[0]
 
@@ -118,51 +216,42 @@ def main(args):
     else:
         best_lr = learning_rate[0]
 
-    for i in tqdm.trange(args.tests):
-        # Continual Regression Experiment (Figure 3)
-        data = prepare_data_evaluation(tasks,
-                                       args.n_functions,
-                                       args.sample_length,
-                                       args.repetitions)
-
-        x_train, y_train, x_val, y_val = data
-
-        # Numpy -> Tensorflow
-        tf.keras.backend.clear_session()
-        rln = tf.keras.models.load_model(args.model_file_rln)
-        tln = tf.keras.models.load_model(args.model_file_tln)
-
-        # Random reinitialization of last layer
-        if args.resetting_last_layer:
-            w = tln.layers[-1].weights[0]
-            b = tln.layers[-1].weights[1]
-            new_w = tf.keras.initializers.he_normal()(shape=w.shape)
-            w.assign(new_w)
-            new_b = tf.keras.initializers.zeros()(shape=b.shape)
-            b.assign(new_b)
-
-        losses = evaluate_models_isw(x_train=x_train,
-                                     y_train=y_train,
-                                     x_val=x_val,
-                                     y_val=y_val,
-                                     rln=rln,
-                                     tln=tln,
-                                     batch_size=args.batch_size_evaluation,
-                                     epochs=1,
-                                     learning_rate=best_lr)
-
-        training_losses, validation_losses = losses
-
-        # For now, we will care only on training losses
-        losses = training_losses
-
-        mean_loss_all = losses[0]
-        loss_per_class_during_training = losses[1]
-        interference_losses = losses[2]
-
-        all_mean_losses.append(mean_loss_all)
-        all_3a_results.append(loss_per_class_during_training)
-        all_3b_results.append(interference_losses)
+    # Every trial is seeded, so the results don't depend on the number of
+    # workers, and none of them reuses the data of the learning rate search
+    seeds = trial_seeds(args.seed, args.tests)
+
+    # Trials are stored as they complete and the ones already stored by an
+    # interrupted run are skipped
+    done = store.seeds(args.model_name, "isw", args.n_functions, best_lr, "loss")
+    pending = [seed for seed in seeds if seed not in done]
+
+    run = functools.partial(run_trial, args, tasks, best_lr)
+    if args.workers > 1:
+        threads = args.threads_per_worker or max(1, os.cpu_count() // args.workers)
+        # TensorFlow is not fork safe, so workers are started from scratch
+        context = multiprocessing.get_context("spawn")
+        with context.Pool(args.workers, initializer=init_worker,
+                          initargs=(threads,)) as pool:
+            for seed, losses in zip(pending, tqdm.tqdm(pool.imap(run, pending),
+                                                       total=len(pending))):
+                store_trial(store, args, best_lr, seed, losses)
+    else:
+        for seed in tqdm.tqdm(pending):
+            store_trial(store, args, best_lr, seed, run(seed))
+
+    for metric, all_results in [("loss", all_mean_losses),
+                                ("3a", all_3a_results),
+                                ("3b", all_3b_results)]:
+        results = {result["seed"]: result["value"] for result in
+                   store.load(model=args.model_name, dataset="isw",
+                              classes=args.n_functions,
+                              learning_rate=best_lr, metric=metric)}
+        all_results.extend(results[seed] for seed in seeds)
+    # The trials that make up the result of this evaluation, e.g. for the
+    # learning curve of checkpoint_watcher.py
+    store.append(args.model_name, "isw", args.n_functions, 0.0, args.seed,
+                 evaluation={"learning_rate": best_lr, "seeds": seeds})
+    store.close()
 
     args.results_dir = args.results_dir.format(args.model_name)
     location = os.path.join(args.results_dir, f"isw_{args.model_name}"
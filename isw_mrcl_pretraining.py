@@ -3,15 +3,23 @@ import argparse
 import datetime
 import os
 import tqdm
+import numpy as np
 import tensorflow as tf
 
 from datasets.synth_datasets import gen_tasks
 from experiments.exp4_2.isw import mrcl_isw
 from experiments.training import pretrain_mrcl, save_models
-from experiments.training import copy_parameters, prepare_data_pre_training
+from experiments.training import WeightCheckpoints
+from experiments.training import copy_parameters, pre_training_episodes
+from experiments.training import training_checkpoint_manager
+from experiments.training import save_training_checkpoint
+from experiments.training import restore_training_checkpoint
+from experiments.training import wait_for_training_checkpoint
 from experiments.evaluation import evaluate_models_isw, prepare_data_evaluation
 from experiments.evaluation import compute_sparsity
 from experiments.evaluation import get_representations_graphics
+from experiments.evaluation import AsyncEvaluation
+from util.profiling import PhaseTimer, ProfilerWindow
 
 
 model_prefix = "isw_mrcl"
@@ -48,6 +56,11 @@ def parse_arguments():
     argument_parser.add_argument("--save_models_every", type=int, default=100,
                                  help="Amount of epochs to pass before saving"
                                       " models")
+    argument_parser.add_argument("--keep_checkpoints", type=int, default=5,
+                                 help="Number of most recent weight"
+                                      " checkpoints kept")
+    argument_parser.add_argument("--float16_checkpoints", action='store_true',
+                                 help="Store weight checkpoints as float16")
     argument_parser.add_argument("--post_results_every", type=int, default=100,
                                  help="Amount of epochs to pass before posting"
                                       " results in Tensorboard")
@@ -56,11 +69,61 @@ def parse_arguments():
                                       " layer of the TLN")
     argument_parser.add_argument("--representation_size", default=900,
                                  type=int, help="Size of representations")
+    argument_parser.add_argument("--prefetch", type=int, default=2,
+                                 help="Number of pre training episodes"
+                                      " generated ahead in the background")
+    argument_parser.add_argument("--compiled", action='store_true',
+                                 help="Run each meta-update as a single"
+                                      " compiled graph")
+    argument_parser.add_argument("--fast_weights", action='store_true',
+                                 help="Run the inner loop on fast weights"
+                                      " instead of assigning the TLN")
+    argument_parser.add_argument("--meta_batch_size", type=int, default=1,
+                                 help="Number of trajectories per meta-update,"
+                                      " processed in parallel (requires"
+                                      " --fast_weights)")
+    argument_parser.add_argument("--checkpoint_dir", type=str,
+                                 default="checkpoints/" + model_prefix,
+                                 help="Directory of the training state"
+                                      " checkpoints")
+    argument_parser.add_argument("--checkpoint_every", type=int, default=100,
+                                 help="Amount of epochs to pass before"
+                                      " checkpointing the training state")
+    argument_parser.add_argument("--resume", action='store_true',
+                                 help="Resume training from the latest"
+                                      " checkpoint in --checkpoint_dir")
+    argument_parser.add_argument("--val_subset_repetitions", type=int,
+                                 default=None,
+                                 help="Number of the validation/train"
+                                      " repetitions used by the periodic"
+                                      " validation (default is all)")
+    argument_parser.add_argument("--async_validation", action='store_true',
+                                 help="Run the periodic validation on a"
+                                      " snapshot of the weights in a"
+                                      " background thread")
+    argument_parser.add_argument("--profile_phases", action='store_true',
+                                 help="Log the wall time of the phases of"
+                                      " every epoch to Tensorboard")
+    argument_parser.add_argument("--profile_epochs", type=int, nargs=2,
+                                 default=None, metavar=("START", "STOP"),
+                                 help="Capture a tf.profiler trace of the"
+                                      " epochs in [START, STOP)")
 
     args = argument_parser.parse_args()
+    if args.meta_batch_size > 1 and not args.fast_weights:
+        argument_parser.error("--meta_batch_size requires --fast_weights")
     return args
 
 
+def tasks_to_variable(tasks):
+    return tf.Variable(np.stack([tasks["amplitude"], tasks["phase"]]))
+
+
+def tasks_from_variable(variable):
+    amplitude, phase = variable.numpy()
+    return {"amplitude": amplitude, "phase": phase}
+
+
 def main(args):
     tr_tasks = gen_tasks(args.n_tasks)  # Generate tasks parameters
     val_tasks = gen_tasks(args.val_tasks)
@@ -87,22 +150,96 @@ def main(args):
     # iteration
     tln_copy = tf.keras.models.clone_model(tln)
 
+    # Everything needed to resume training, including the tasks and the
+    # seeds of the episode stream and of the validation data
+    data_state = {"tr_tasks": tasks_to_variable(tr_tasks),
+                  "val_tasks": tasks_to_variable(val_tasks),
+                  "seeds": tf.Variable(np.random.randint(2 ** 31, size=2),
+                                       dtype=tf.int64)}
+    manager = training_checkpoint_manager(args.checkpoint_dir, rln=rln,
+                                          tln=tln, tln_copy=tln_copy,
+                                          meta_optimizer=meta_optimizer,
+                                          **data_state)
+    start_epoch = 0
+    if args.resume:
+        start_epoch = restore_training_checkpoint(manager)
+        tr_tasks = tasks_from_variable(data_state["tr_tasks"])
+        val_tasks = tasks_from_variable(data_state["val_tasks"])
+    stream_seed, val_seed = (int(seed) for seed in data_state["seeds"].numpy())
+
     # Validation and online training data
     val_data = prepare_data_evaluation(val_tasks,
                                        args.n_functions,
                                        args.sample_length,
-                                       args.val_repetitions)
+                                       args.val_repetitions,
+                                       seed=val_seed)
     x_train, y_train, x_val, y_val = val_data
+    if args.val_subset_repetitions is not None:
+        # The periodic validation trains on a fixed subset of the repetitions
+        n_samples = args.val_subset_repetitions * args.sample_length
+        x_train, y_train = x_train[:, :n_samples], y_train[:, :n_samples]
 
     eval_lr = args.evaluation_learning_rate
+    # A single trajectory is fed without the meta-batch axis
+    meta_batch_size = args.meta_batch_size if args.meta_batch_size > 1 else None
+
+    # Stream of pre training episodes, a resumed run skips the episodes of
+    # the epochs it already trained on
+    episodes = pre_training_episodes(tr_tasks,
+                                     args.n_functions,
+                                     args.sample_length,
+                                     args.pt_repetitions,
+                                     meta_batch_size=meta_batch_size,
+                                     prefetch=args.prefetch,
+                                     seed=stream_seed)
+    episodes = iter(episodes.skip(start_epoch))
+
+    # Cheap periodic checkpoints, the full models are exported at the end
+    weight_checkpoints = WeightCheckpoints(model_prefix,
+                                           keep=args.keep_checkpoints,
+                                           float16=args.float16_checkpoints)
+
+    def validate(rln, tln, epoch, pt_loss, x_rand):
+        # Trains the given TLN, so it is run on a copy or a snapshot
+        sparsity = compute_sparsity(tf.reshape(x_rand, [-1, x_rand.shape[-1]]),
+                                    rln, tln)
+
+        with train_summary_writer.as_default():
+            tf.summary.scalar('Sparsity', sparsity, step=epoch)
+            tf.summary.scalar('Training loss', pt_loss, step=epoch)
+
+        rep = get_representations_graphics(x_val, rln)
+        with train_summary_writer.as_default():
+            tf.summary.image("representation", rep, epoch)
 
-    t = tqdm.trange(args.epochs)
+        losses = evaluate_models_isw(x_train=x_train,
+                                     y_train=y_train,
+                                     x_val=x_val,
+                                     y_val=y_val,
+                                     tln=tln,
+                                     rln=rln,
+                                     learning_rate=eval_lr)
+
+        mean_loss_all_val = losses[1][0]
+
+        with train_summary_writer.as_default():
+            tf.summary.scalar('Validation loss', mean_loss_all_val,
+                              step=epoch)
+        print(f"Epoch: {epoch}\tSparsity: {sparsity}\t"
+              f"Mean loss: {mean_loss_all_val}")
+
+    validation = None
+    if args.async_validation:
+        validation = AsyncEvaluation(validate, rln, tln)
+
+    timer = PhaseTimer(enabled=args.profile_phases)
+    profiler = ProfilerWindow(train_log_dir, *(args.profile_epochs or ()))
+
+    t = tqdm.trange(start_epoch, args.epochs)
     for epoch in t:
-        tr_data = prepare_data_pre_training(tr_tasks,
-                                            args.n_functions,
-                                            args.sample_length,
-                                            args.pt_repetitions)
-        x_traj, y_traj, x_rand, y_rand = tr_data
+        profiler.step(epoch)
+        with timer.phase("data"):
+            x_traj, y_traj, x_rand, y_rand = next(episodes)
 
         # Pretrain step
         pt_loss = pretrain_mrcl(x_traj=x_traj, y_traj=y_traj,
@@ -111,43 +248,39 @@ def main(args):
                                 meta_optimizer=meta_optimizer,
                                 loss_function=loss_fun,
                                 beta=args.inner_learning_rate,
-                                reset_last_layer=args.resetting_last_layer)
+                                reset_last_layer=args.resetting_last_layer,
+                                compiled=args.compiled,
+                                fast_weights=args.fast_weights,
+                                timer=timer)
         t.set_description(f"{pt_loss:.3}")
         # Check metrics for Tensorboard to be included every
         # "post_results_every" epochs
         if epoch % args.post_results_every == 0:
-            sparsity = compute_sparsity(x_rand, rln, tln)
-
-            with train_summary_writer.as_default():
-                tf.summary.scalar('Sparsity', sparsity, step=epoch)
-                tf.summary.scalar('Training loss', pt_loss, step=epoch)
-
-            rep = get_representations_graphics(x_val, rln)
-            with train_summary_writer.as_default():
-                tf.summary.image("representation", rep, epoch)
-
-            copy_parameters(tln, tln_copy)
-
-            losses = evaluate_models_isw(x_train=x_train,
-                                         y_train=y_train,
-                                         x_val=x_val,
-                                         y_val=y_val,
-                                         tln=tln_copy,
-                                         rln=rln,
-                                         learning_rate=eval_lr)
-
-            mean_loss_all_val = losses[1][0]
-
-            with train_summary_writer.as_default():
-                tf.summary.scalar('Validation loss', mean_loss_all_val,
-                                  step=epoch)
-            print(f"Epoch: {epoch}\tSparsity: {sparsity}\t"
-                  f"Mean loss: {mean_loss_all_val}")
-
-        # Save model every "save_models_every" epochs
-        if epoch % args.save_models_every == 0 and epoch > 0:
-            save_models(model=rln, name=model_prefix + f"_rln")
-            save_models(model=tln, name=model_prefix + f"_tln")
+            if validation is not None:
+                with timer.phase("evaluation"):
+                    validation.submit(epoch, pt_loss, x_rand)
+            else:
+                with timer.phase("copies"):
+                    copy_parameters(tln, tln_copy)
+                with timer.phase("evaluation"):
+                    validate(rln, tln_copy, epoch, pt_loss, x_rand)
+
+        with timer.phase("checkpointing"):
+            # Save model weights every "save_models_every" epochs
+            if epoch % args.save_models_every == 0 and epoch > 0:
+                weight_checkpoints.save(epoch, rln=rln, tln=tln)
+
+            if (epoch + 1) % args.checkpoint_every == 0:
+                save_training_checkpoint(manager, epoch)
+
+        with train_summary_writer.as_default():
+            timer.write(epoch)
+
+    profiler.close()
+    if validation is not None:
+        validation.wait()
+    save_training_checkpoint(manager, args.epochs - 1)
+    wait_for_training_checkpoint(manager)
 
     # Save final model
     save_models(model=rln, name=model_prefix + f"_rln")
@@ -10,8 +10,9 @@ import tensorflow as tf
 
 from datasets.synth_datasets import gen_sine_data, gen_tasks
 from experiments.exp4_2.isw import mrcl_isw
-from experiments.training import pretrain_mrcl, save_models, to_iid
-from experiments.training import copy_parameters, prepare_data_pre_training
+from experiments.training import pretrain_mrcl, save_models
+from experiments.training import WeightCheckpoints
+from experiments.training import copy_parameters, pre_training_episodes
 from experiments.evaluation import evaluate_models_isw, prepare_data_evaluation
 from experiments.evaluation import compute_sparsity, get_representations_graphics
 from baseline_methods.pretraining import PretrainingBaseline
@@ -50,14 +51,21 @@ def main(args):
 
     eval_optimizer = tf.keras.optimizers.SGD(learning_rate=0.003)
 
+    # Stream of shuffled pre training episodes
+    episodes = iter(pre_training_episodes(tr_tasks,
+                                          args.n_functions,
+                                          args.sample_length,
+                                          args.pt_repetitions,
+                                          iid=True,
+                                          prefetch=args.prefetch))
+
+    # Cheap periodic checkpoints, the full models are exported at the end
+    weight_checkpoints = WeightCheckpoints(model_prefix,
+                                           keep=args.keep_checkpoints,
+                                           float16=args.float16_checkpoints)
+
     for epoch in tqdm.trange(args.epochs):
-        tr_data = prepare_data_pre_training(tr_tasks,
-                                            args.n_functions,
-                                            args.sample_length,
-                                            args.pt_repetitions)
-        x_traj, y_traj, _, _ = tr_data
-        x_traj, y_traj = to_iid(x_traj, y_traj, args.n_functions,
-args.sample_length, args.pt_repetitions)
+        x_traj, y_traj, _, _ = next(episodes)
 
         # Pretrain step
         pt_loss = pb.pre_train(x_traj, y_traj, args.learning_rate)
@@ -92,10 +100,9 @@ args.sample_length, args.pt_repetitions)
             print(f"Epoch: {epoch}\tSparsity: {sparsity}\t"
                   f"Mean loss: {mean_loss_all_val}")
 
-        # Save model every "save_models_every" epochs
+        # Save model weights every "save_models_every" epochs
         if epoch % args.save_models_every == 0 and epoch > 0:
-            save_models(model=pb.model_rln, name=model_prefix + f"_rln")
-            save_models(model=pb.model_tln, name=model_prefix + f"_tln")
+            weight_checkpoints.save(epoch, rln=pb.model_rln, tln=pb.model_tln)
 
     # Save final model
     save_models(model=pb.model_rln, name=model_prefix + f"_rln")
@@ -125,6 +132,11 @@ if __name__ == '__main__':
     argument_parser.add_argument("--save_models_every", type=int, default=100,
                                  help="Amount of epochs to pass before saving"
                                       " models")
+    argument_parser.add_argument("--keep_checkpoints", type=int, default=5,
+                                 help="Number of most recent weight"
+                                      " checkpoints kept")
+    argument_parser.add_argument("--float16_checkpoints", action='store_true',
+                                 help="Store weight checkpoints as float16")
     argument_parser.add_argument("--post_results_every", type=int, default=1000,
                                  help="Amount of epochs to pass before posting"
                                       " results in Tensorboard")
@@ -133,6 +145,9 @@ if __name__ == '__main__':
                                       " the TLN")
     argument_parser.add_argument("--representation_size", default=900, type=int,
                                  help="Size of representations")
+    argument_parser.add_argument("--prefetch", type=int, default=2,
+                                 help="Number of pre training episodes"
+                                      " generated ahead in the background")
 
     args = argument_parser.parse_args()
     main(args)
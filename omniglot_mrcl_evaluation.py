@@ -1,16 +1,43 @@
+import argparse
 import tensorflow as tf
 import numpy as np
 import os
 import json
 
 
-from experiments.exp4_2.omniglot_model import mrcl_omniglot, get_eval_data_by_classes, evaluate_classification_mrcl
-from datasets.tf_datasets import load_omniglot
+from experiments.exp4_2.omniglot_model import mrcl_omniglot, get_eval_data_by_classes, OmniglotEvaluator
+from experiments.evaluation import ModelPool, trial_seeds
+from experiments.training import load_weights
+from util.results_store import ResultsStore
+from datasets.tf_datasets import load_omniglot_arrays
 from parameters import classification_parameters
 
 
-def evaluate(model_name, model_type="mrcl"):
-    _, evaluation_data = load_omniglot(verbose=1)
+def evaluate_repeats(evaluator, store, model, point, learning_rate, metric, sweep_seed=0, repeats=50):
+    """
+    Accuracies of repeated evaluation runs, appended to the store as they complete. Runs already in the store are not
+    evaluated again. Every run is seeded by its stored seed, none of them by the seed of the learning rate sweep.
+    :param metric: "test_accuracy" or "train_accuracy"
+    :param sweep_seed: Seed of the runs of the learning rate sweep
+    :rtype: list
+    """
+    run_seeds = trial_seeds(sweep_seed, repeats)
+    done = store.seeds(model, "omniglot", point, learning_rate, metric)
+    pending = [seed for seed in run_seeds if seed not in done]
+    for start in range(0, len(pending), evaluator.max_parallel_runs):
+        seeds = pending[start:start + evaluator.max_parallel_runs]
+        test_accuracies, train_accuracies = evaluator.evaluate(point, [learning_rate] * len(seeds), seeds=seeds)
+        accuracies = test_accuracies if metric == "test_accuracy" else train_accuracies
+        for seed, accuracy in zip(seeds, accuracies):
+            store.append(model, "omniglot", point, learning_rate, seed, **{metric: float(accuracy)})
+    results = {result["seed"]: result["value"] for result in store.load(model=model, dataset="omniglot",
+                                                                         classes=point, learning_rate=learning_rate,
+                                                                         metric=metric)}
+    return [results[seed] for seed in run_seeds]
+
+
+def evaluate(model_name, model_type="mrcl", results_db="results/results.db", sparse=False, seed=0):
+    _, evaluation_data = load_omniglot_arrays(verbose=1)
     evaluation_training_data, evaluation_test_data = get_eval_data_by_classes(evaluation_data)
     save_dir = "results/omniglot/" + model_type
     try:
@@ -18,68 +45,81 @@ def evaluate(model_name, model_type="mrcl"):
     except IOError:
         os.mkdir(save_dir)
 
+    if model_name.endswith(".npz"):
+        # Weight checkpoint of pretraining, e.g. pretraining_mrcl_999.npz
+        model_files = ["saved_models/" + model_name]
+        saved_weights = load_weights(model_files[0])
+        rln_saved_weights, tln_saved_weights = saved_weights["rln"], saved_weights["tln"]
+    else:
+        model_files = ["saved_models/rln_" + model_name, "saved_models/tln_" + model_name]
+        models = ModelPool()
+        rln_saved_weights, tln_saved_weights = [models.weights(path) for path in model_files]
+
+    # The RLN stays frozen during evaluation, so the representations of the evaluation data are computed only once
+    rln, _ = mrcl_omniglot()
+    rln.set_weights(rln_saved_weights)
+    evaluator = OmniglotEvaluator(evaluation_training_data, evaluation_test_data, rln, classification_parameters,
+                                  sparse=sparse)
+
     points = [10, 50, 75, 100, 150, 200]
+    lrs = [0.3, 0.1, 0.03, 0.01, 0.003, 0.001, 0.0003, 0.0001, 0.00003, 0.00001]
+    repeats = 50
+
+    # Results are stored as they complete, so an interrupted evaluation resumes where it stopped, but only with the
+    # same configuration
+    store = ResultsStore(results_db)
+    model = f"{model_type}/{model_name}"
+    store.check_config(model, "omniglot", {"model_files": model_files, "points": points, "learning_rates": lrs,
+                                           "repeats": repeats, "sparse": sparse, "seed": seed})
+
     for point in points:
-        lrs = [0.3, 0.1, 0.03, 0.01, 0.003, 0.001, 0.0003, 0.0001, 0.00003, 0.00001]
-        test_accuracy_results = []
-        train_accuracy_results = []
-        for lr in lrs:
-            tf.keras.backend.clear_session()
-
-            _, original_tln = mrcl_omniglot(classes=point)
-            rln_saved = tf.keras.models.load_model("saved_models/rln_" + model_name)
-            tln_saved = tf.keras.models.load_model("saved_models/tln_" + model_name)
-
-            tln_weights = [tln_saved.get_weights()[0], tln_saved.get_weights()[1], original_tln.get_weights()[2], original_tln.get_weights()[3]]
-            classification_parameters["online_learning_rate"] = lr
-            rln, tln = mrcl_omniglot(classes=point)
-            tln.set_weights(tln_weights)
-            rln.set_weights(rln_saved.get_weights())
-            test_accuracy, train_accuracy = evaluate_classification_mrcl(evaluation_training_data, evaluation_test_data,
-                                                                         rln, tln, point, classification_parameters)
-            test_accuracy_results.append(test_accuracy)
-            train_accuracy_results.append(train_accuracy)
+        # Test and train accuracy of every learning rate
+        sweep = {result["learning_rate"]: result["value"] for result in
+                 store.load(model=model, dataset="omniglot", classes=point, metric="sweep_accuracy")}
+        if any(lr not in sweep for lr in lrs):
+            # All learning rates are evaluated together on the same episode, each one on a TLN with the same freshly
+            # initialized output layer
+            tln_weights = [tln_saved_weights[:2] + evaluator.initial_tln_weights(point, seed=seed)[2:]
+                           for _ in lrs]
+            for lr, test_accuracy, train_accuracy in zip(lrs, *evaluator.evaluate(point, lrs, tln_weights,
+                                                                                   seeds=[seed] * len(lrs))):
+                sweep[lr] = [float(test_accuracy), float(train_accuracy)]
+                store.append(model, "omniglot", point, lr, seed, sweep_accuracy=sweep[lr])
+        test_accuracy_results, train_accuracy_results = zip(*[sweep[lr] for lr in lrs])
+        for lr, test_accuracy, train_accuracy in zip(lrs, test_accuracy_results, train_accuracy_results):
             print(f"Learning rate {lr}, test accuracy {test_accuracy}, train accuracy {train_accuracy}")
 
-        test_lr = lrs[np.argmax(np.array(test_accuracy_results))]
-        train_lr = lrs[np.argmax(np.array(train_accuracy_results))]
+        test_lr = lrs[np.argmax(test_accuracy_results)]
+        train_lr = lrs[np.argmax(train_accuracy_results)]
         print(
             f"Number of classes {point}. Best testing learning rate is {test_lr} and best training learning rate is {train_lr}.")
-        test_accuracy_results = []
-        train_accuracy_results = []
 
         print(f"Starting 50 iterations of evaluation testing with learning rate {test_lr}.")
-        for _ in range(50):
-            classification_parameters["online_learning_rate"] = test_lr
-            tf.keras.backend.clear_session()
-
-            _, original_tln = mrcl_omniglot(classes=point)
-            rln, tln = mrcl_omniglot(classes=point)
-            rln_saved = tf.keras.models.load_model("saved_models/rln_" + model_name)
-            tln.set_weights(original_tln.get_weights())
-            rln.set_weights(rln_saved.get_weights())
-            test_accuracy, _ = evaluate_classification_mrcl(evaluation_training_data, evaluation_test_data, rln, tln,
-                                                            point, classification_parameters)
-            test_accuracy_results.append(str(test_accuracy))
+        test_accuracy_results = evaluate_repeats(evaluator, store, model, point, test_lr, "test_accuracy",
+                                                 sweep_seed=seed, repeats=repeats)
         with open(f"{save_dir}/{model_type}_omniglot_testing_{point}.json",
                   'w') as f:  # writing JSON object
-            json.dump(test_accuracy_results, f)
+            json.dump([str(np.float32(test_accuracy)) for test_accuracy in test_accuracy_results], f)
 
         print(f"Starting 50 iterations of evaluation training with learning rate {train_lr}.")
-        for _ in range(50):
-            classification_parameters["online_learning_rate"] = train_lr
-            tf.keras.backend.clear_session()
-            _, original_tln = mrcl_omniglot(classes=point)
-            rln_saved = tf.keras.models.load_model("saved_models/rln_" + model_name)
-            rln, tln = mrcl_omniglot(classes=point)
-
-            tln.set_weights(original_tln.get_weights())
-            rln.set_weights(rln_saved.get_weights())
-            _, train_accuracy = evaluate_classification_mrcl(evaluation_training_data, evaluation_test_data, rln,
-                                                             tln, point, classification_parameters)
-            train_accuracy_results.append(str(train_accuracy))
+        train_accuracy_results = evaluate_repeats(evaluator, store, model, point, train_lr, "train_accuracy",
+                                                  sweep_seed=seed, repeats=repeats)
         with open(f"{save_dir}/{model_type}_omniglot_training_{point}.json",
                   'w') as f:  # writing JSON object
-            json.dump(train_accuracy_results, f)
+            json.dump([str(np.float32(train_accuracy)) for train_accuracy in train_accuracy_results], f)
+    store.close()
+
 
-#evaluate("pretraining_mrcl_11999_omniglot.tf")
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("model_name", help="Models in saved_models, e.g. pretraining_mrcl_11999_omniglot.tf for "
+                                           "the rln_ and tln_ SavedModels or pretraining_mrcl_999.npz")
+    parser.add_argument("--model_type", default="mrcl")
+    parser.add_argument("--results_db", default="results/results.db")
+    parser.add_argument("--sparse", action='store_true',
+                        help="Online training only on the nonzero elements of the representations if they are sparse")
+    parser.add_argument("--seed", default=0, type=int,
+                        help="Seed of the learning rate sweep, the repeated runs are seeded with the following seeds")
+    args = parser.parse_args()
+    evaluate(args.model_name, model_type=args.model_type, results_db=args.results_db, sparse=args.sparse,
+             seed=args.seed)
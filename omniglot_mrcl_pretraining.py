@@ -1,47 +1,150 @@
+import argparse
+import os
+import sys
+
 import tensorflow as tf
 import datetime
 import numpy as np
 
 from experiments.exp4_2.omniglot_model import mrcl_omniglot, get_background_data_by_classes, \
-    partition_into_disjoint, pretrain_classification_mrcl, sample_trajectory, sample_random, sample_random_10_classes
-from datasets.tf_datasets import load_omniglot
-from experiments.training import save_models
+    partition_into_disjoint, pretrain_classification_mrcl, sample_trajectory, sample_random, sample_random_10_classes, \
+    sample_meta_batch
+from datasets.tf_datasets import load_omniglot_arrays
+from experiments.evaluation import compute_sparsity
+from experiments.training import save_models, WeightCheckpoints, training_checkpoint_manager, save_training_checkpoint, \
+    restore_training_checkpoint, wait_for_training_checkpoint, dtype_policy
 from parameters import classification_parameters
+from util.distributed import multi_worker_strategy, WorkerGroup, launch_local_workers
+from util.profiling import PhaseTimer, ProfilerWindow
 
 
-def pretrain(sort_samples=True, model_name="mrcl"):
+def pretrain(sort_samples=True, model_name="mrcl", fast_weights=False, meta_batch_size=1, resume=False,
+             checkpoint_dir=None, checkpoint_every=100, keep_checkpoints=None, float16_checkpoints=False, xla=False,
+             mixed_precision=False, epochs=15000, workers=None, profile_phases=False, profile_epochs=None):
+    """
+    :param workers: WorkerGroup of a data-parallel pretraining. Every worker samples its own trajectories and the
+                    outer gradients are averaged over the workers, only the chief writes logs, checkpoints and models.
+    :param profile_phases: Log the wall time of the phases of every epoch
+    :param profile_epochs: (start, stop) epochs of a tf.profiler trace
+    """
+    if meta_batch_size > 1 and not fast_weights:
+        raise ValueError("Meta-batches of more than one trajectory require fast weights")
+    if xla and not fast_weights:
+        raise ValueError("XLA compilation requires fast weights")
     print(f"GPU is available: {tf.test.is_gpu_available()}")
 
-    background_data, _ = load_omniglot(verbose=1)
-    background_training_data, _, _ = get_background_data_by_classes(background_data, sort=sort_samples)
-    s_learn, s_remember = partition_into_disjoint(background_training_data)
-
-    rln, tln = mrcl_omniglot()
-
-    t = range(15000)
+    # Layers take the policy when they are created, so all the models are built under it
+    with dtype_policy("mixed_bfloat16" if mixed_precision else None):
+        rln, tln = mrcl_omniglot()
+        # Fast weights leave the TLN variables untouched during the inner loop, so no clone is needed
+        tln_initial = None if fast_weights else tf.keras.models.clone_model(tln)
+    is_chief = workers is None or workers.is_chief
 
     current_time = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
     train_log_dir = 'logs/classification/pretraining/omniglot/' + model_name + '/gradient_tape/' + current_time + '/train'
-    train_summary_writer = tf.summary.create_file_writer(train_log_dir)
+    train_summary_writer = tf.summary.create_file_writer(train_log_dir) if is_chief else tf.summary.create_noop_writer()
+
+    # The meta optimizer is created anew on every update, so the models, the epoch, the random state of the
+    # sampling and the seed of the grouping of the samples are the whole training state
+    data_seed = tf.Variable(np.random.randint(2 ** 31), dtype=tf.int64)
+    state = {"rln": rln, "tln": tln, "data_seed": data_seed}
+    if tln_initial is not None:
+        state["tln_initial"] = tln_initial
+    manager = training_checkpoint_manager(checkpoint_dir or f"checkpoints/omniglot_{model_name}", **state)
+    start_epoch = restore_training_checkpoint(manager) if resume else 0
+    if workers is not None:
+        # Same models and grouping of the samples on all workers, but different samples
+        workers.broadcast_variables(rln.variables + tln.variables + [data_seed])
+        if not workers.is_chief:
+            np.random.seed([int(data_seed.numpy()), start_epoch, workers.task_id])
+
+    sampling_state = np.random.get_state()
+    np.random.seed(int(data_seed.numpy()))
+    background_data, _ = load_omniglot_arrays(verbose=1)
+    background_training_data, _, _ = get_background_data_by_classes(background_data, sort=sort_samples)
+    s_learn, s_remember = partition_into_disjoint(background_training_data)
+    np.random.set_state(sampling_state)
+
+    # Weights of the models every 1000 epochs, e.g. saved_models/pretraining_mrcl_999.npz
+    weight_checkpoints = WeightCheckpoints(f"pretraining_{model_name}", keep=keep_checkpoints,
+                                           float16=float16_checkpoints)
 
-    tln_initial = tf.keras.models.clone_model(tln)
+    timer = PhaseTimer(enabled=profile_phases and is_chief)
+    profiler = ProfilerWindow(train_log_dir, *(profile_epochs if profile_epochs and is_chief else ()))
 
-    for epoch, v in enumerate(t):
-        x_rand, y_rand = sample_random_10_classes(s_remember, background_training_data)
-        x_traj, y_traj = sample_trajectory(s_learn, background_training_data)
+    for epoch in range(start_epoch, epochs):
+        profiler.step(epoch)
+        with timer.phase("data"):
+            if meta_batch_size > 1:
+                x_traj, y_traj, x_rand, y_rand = sample_meta_batch(s_learn, s_remember, background_training_data,
+                                                                   meta_batch_size)
+            else:
+                x_rand, y_rand = sample_random_10_classes(s_remember, background_training_data)
+                x_traj, y_traj = sample_trajectory(s_learn, background_training_data)
 
-        loss = pretrain_classification_mrcl(x_traj, y_traj, x_rand, y_rand, rln, tln, tln_initial, classification_parameters)
+        loss = pretrain_classification_mrcl(x_traj, y_traj, x_rand, y_rand, rln, tln, tln_initial, classification_parameters,
+                                            fast_weights=fast_weights, jit_compile=xla, workers=workers, timer=timer)
+        if not is_chief:
+            continue
 
         # Check metrics
-        rep = rln(x_rand)
-        rep = np.array(rep)
-        counts = np.isclose(rep, 0).sum(axis=1) / rep.shape[1]
-        sparsity = np.mean(counts)
+        with timer.phase("evaluation"):
+            sparsity = compute_sparsity(tf.reshape(x_rand, [-1, 84, 84, 1]), rln, tln)
+            with train_summary_writer.as_default():
+                tf.summary.scalar('Sparsity', sparsity, step=epoch)
+                tf.summary.scalar('Training loss', loss, step=epoch)
+        with timer.phase("checkpointing"):
+            if (epoch+1) % 1000 == 0:
+                print("Epoch:", epoch, "Sparsity:", sparsity, "Training loss:", loss.numpy())
+                weight_checkpoints.save(epoch, rln=rln, tln=tln)
+            if (epoch + 1) % checkpoint_every == 0:
+                save_training_checkpoint(manager, epoch)
         with train_summary_writer.as_default():
-            tf.summary.scalar('Sparsity', sparsity, step=epoch)
-            tf.summary.scalar('Training loss', loss, step=epoch)
-        if (epoch+1) % 1000 == 0:
-            print("Epoch:", epoch, "Sparsity:", sparsity, "Training loss:", loss.numpy())
-            save_models(tln, f"tln_pretraining_{model_name}_{epoch}_omniglot")
-            save_models(rln, f"rln_pretraining_{model_name}_{epoch}_omniglot")
+            timer.write(epoch)
+
+    profiler.close()
+    if not is_chief:
+        return
+    wait_for_training_checkpoint(manager)
+
+    # Export the final models
+    save_models(tln, f"tln_pretraining_{model_name}_{epochs - 1}_omniglot")
+    save_models(rln, f"rln_pretraining_{model_name}_{epochs - 1}_omniglot")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_name", default="mrcl")
+    parser.add_argument("--unsorted", action="store_true", help="Don't sort the samples of each class")
+    parser.add_argument("--fast_weights", action="store_true")
+    parser.add_argument("--meta_batch_size", type=int, default=1)
+    parser.add_argument("--epochs", type=int, default=15000)
+    parser.add_argument("--resume", action="store_true")
+    parser.add_argument("--checkpoint_dir", default=None)
+    parser.add_argument("--checkpoint_every", type=int, default=100)
+    parser.add_argument("--keep_checkpoints", type=int, default=None)
+    parser.add_argument("--float16_checkpoints", action="store_true")
+    parser.add_argument("--xla", action="store_true")
+    parser.add_argument("--mixed_precision", action="store_true")
+    parser.add_argument("--profile_phases", action="store_true",
+                        help="Log the wall time of the phases of every epoch to TensorBoard")
+    parser.add_argument("--profile_epochs", type=int, nargs=2, default=None, metavar=("START", "STOP"),
+                        help="Capture a tf.profiler trace of the epochs in [START, STOP)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of local worker processes of a data-parallel pretraining. Workers on several "
+                             "machines are started with TF_CONFIG set instead.")
+    args = parser.parse_args()
+
+    if args.workers > 1 and "TF_CONFIG" not in os.environ:
+        launch_local_workers([os.path.abspath(__file__)] + sys.argv[1:], args.workers)
+        sys.exit()
+
+    # The strategy has to be created before any other TensorFlow operation
+    worker_group = WorkerGroup(multi_worker_strategy()) if "TF_CONFIG" in os.environ else None
+    pretrain(sort_samples=not args.unsorted, model_name=args.model_name, fast_weights=args.fast_weights,
+             meta_batch_size=args.meta_batch_size, resume=args.resume, checkpoint_dir=args.checkpoint_dir,
+             checkpoint_every=args.checkpoint_every, keep_checkpoints=args.keep_checkpoints,
+             float16_checkpoints=args.float16_checkpoints, xla=args.xla, mixed_precision=args.mixed_precision,
+             epochs=args.epochs, workers=worker_group, profile_phases=args.profile_phases,
+             profile_epochs=args.profile_epochs)
 
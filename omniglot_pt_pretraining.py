@@ -3,31 +3,19 @@ import datetime
 import numpy as np
 
 from experiments.exp4_2.omniglot_model import mrcl_omniglot, get_background_data_by_classes, get_eval_data_by_classes, pre_train, get_output
-from datasets.tf_datasets import load_omniglot
+from datasets.tf_datasets import load_omniglot_arrays
 from experiments.training import save_models
 from parameters import pretraining_parameters
 
 print(f"GPU is available: {tf.test.is_gpu_available()}")
 
-background_data, _ = load_omniglot(verbose=1)
+background_data, _ = load_omniglot_arrays(verbose=1)
 _, background_training_data_15, background_training_data_5 = get_background_data_by_classes(background_data)
-x_training = []
-y_training = []
-for class_id in range(len(background_training_data_15)):
-    for training_item in background_training_data_15[class_id]:
-        x_training.append(training_item['image'])
-        y_training.append(training_item['label'])
-x_training = tf.convert_to_tensor(x_training)
-y_training = tf.convert_to_tensor(y_training)
+x_training = tf.convert_to_tensor(background_training_data_15.images.reshape(-1, 84, 84, 1))
+y_training = tf.convert_to_tensor(background_training_data_15.labels.reshape(-1))
 
-x_testing = []
-y_testing = []
-for class_id in range(len(background_training_data_5)):
-    for training_item in background_training_data_5[class_id]:
-        x_testing.append(training_item['image'])
-        y_testing.append(training_item['label'])
-x_testing = tf.convert_to_tensor(x_testing)
-y_testing = tf.convert_to_tensor(y_testing)
+x_testing = tf.convert_to_tensor(background_training_data_5.images.reshape(-1, 84, 84, 1))
+y_testing = tf.convert_to_tensor(background_training_data_5.labels.reshape(-1))
 
 t = range(100)
 current_time = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
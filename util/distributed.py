@@ -0,0 +1,115 @@
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import tensorflow as tf
+
+
+def multi_worker_strategy():
+    """
+    MultiWorkerMirroredStrategy for the cluster described by the TF_CONFIG environment variable. It has to be created
+    at program startup, before any other TensorFlow operation.
+    """
+    if hasattr(tf.distribute, "MultiWorkerMirroredStrategy"):
+        return tf.distribute.MultiWorkerMirroredStrategy()
+    return tf.distribute.experimental.MultiWorkerMirroredStrategy()
+
+
+class WorkerGroup:
+    """
+    Collective operations between the workers of a MultiWorkerMirroredStrategy on plain tensors. The models stay
+    ordinary local variables: every worker applies the same all-reduced updates, so their copies stay identical.
+    """
+    def __init__(self, strategy):
+        """
+        :param strategy: MultiWorkerMirroredStrategy, see multi_worker_strategy
+        """
+        self.strategy = strategy
+        self.task_id = strategy.cluster_resolver.task_id
+        self.num_workers = strategy.num_replicas_in_sync
+        self.is_chief = self.task_id == 0
+
+        def replica_all_reduce(reduce_op, *tensors):
+            # The identities place the inputs on the replica's device, plain inputs have no reduction destination
+            return tf.distribute.get_replica_context().all_reduce(reduce_op, [tf.identity(t) for t in tensors])
+
+        @tf.function
+        def all_reduce(reduce_op, tensors):
+            return self.strategy.run(replica_all_reduce, args=(reduce_op,) + tuple(tensors))
+        self._all_reduce = all_reduce
+
+    def all_reduce(self, reduce_op, tensors):
+        """
+        :param reduce_op: tf.distribute.ReduceOp
+        :param tensors: List of tensors with the same shapes on every worker
+        :return: List of the reduced tensors
+        """
+        tensors = list(tensors)
+        # Tensors are packed into a single collective per dtype
+        reduced = [None] * len(tensors)
+        for dtype in {t.dtype for t in tensors}:
+            indexes = [i for i, t in enumerate(tensors) if t.dtype == dtype]
+            for i, t in zip(indexes, self._all_reduce(reduce_op, [tensors[i] for i in indexes])):
+                reduced[i] = self.strategy.experimental_local_results(t)[0]
+        return reduced
+
+    def mean(self, tensors):
+        return self.all_reduce(tf.distribute.ReduceOp.MEAN, tensors)
+
+    def broadcast(self, tensors):
+        """
+        The chief's values of the tensors on every worker
+        """
+        if not self.is_chief:
+            tensors = [tf.zeros_like(t) for t in tensors]
+        return self.all_reduce(tf.distribute.ReduceOp.SUM, tensors)
+
+    def broadcast_variables(self, variables):
+        """
+        Assign the chief's values to the variables of every worker
+        """
+        for v, value in zip(variables, self.broadcast([v.read_value() for v in variables])):
+            v.assign(value)
+
+
+def local_cluster(n_workers):
+    """
+    Cluster spec of n_workers workers on free ports of this machine
+    """
+    sockets = [socket.socket() for _ in range(n_workers)]
+    for s in sockets:
+        s.bind(("localhost", 0))
+    ports = [s.getsockname()[1] for s in sockets]
+    for s in sockets:
+        s.close()
+    return {"worker": [f"localhost:{port}" for port in ports]}
+
+
+def launch_local_workers(arguments, n_workers):
+    """
+    Run a script as n_workers processes on this machine that form a cluster through TF_CONFIG and wait for all of them
+    :param arguments: Script and its command line arguments, run with the current Python interpreter
+    :raises RuntimeError: If a worker fails, the remaining workers are terminated
+    """
+    cluster = local_cluster(n_workers)
+    workers = []
+    for index in range(n_workers):
+        env = dict(os.environ, TF_CONFIG=json.dumps({"cluster": cluster, "task": {"type": "worker", "index": index}}))
+        workers.append(subprocess.Popen([sys.executable] + list(arguments), env=env))
+
+    # Poll all workers, the others would wait forever on the collective operations of a failed worker
+    while any(worker.poll() is None for worker in workers):
+        if any(worker.returncode for worker in workers):
+            for worker in workers:
+                if worker.poll() is None:
+                    worker.terminate()
+            break
+        time.sleep(1)
+    for worker in workers:
+        worker.wait()
+    failed = [index for index, worker in enumerate(workers) if worker.returncode]
+    if failed:
+        raise RuntimeError(f"Workers {failed} failed")
@@ -0,0 +1,83 @@
+import collections
+import contextlib
+import time
+
+import tensorflow as tf
+
+
+class PhaseTimer:
+    """
+    Wall time of the phases of training epochs (e.g. data, inner_loop, outer_gradient, optimizer, copies, evaluation,
+    checkpointing), written as TensorBoard scalars. Phases are also annotated in tf.profiler traces. A disabled timer
+    only runs the timed code, so it can be passed around unconditionally.
+    """
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.times = collections.defaultdict(float)
+        self.last_write = time.perf_counter()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+        Add the wall time of the enclosed code to the phase. Phases shouldn't be nested.
+        """
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            with tf.profiler.experimental.Trace(name):
+                yield
+        finally:
+            self.times[name] += time.perf_counter() - start
+
+    def write(self, step, prefix="Time"):
+        """
+        Write the seconds spent in every phase since the last write, and the wall time of the whole period, as scalars
+        of the default summary writer
+        """
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        for name, seconds in self.times.items():
+            tf.summary.scalar(f"{prefix}/{name}", seconds, step=step)
+        tf.summary.scalar(f"{prefix}/epoch", now - self.last_write, step=step)
+        self.times.clear()
+        self.last_write = now
+
+
+# Timer of the functions that take an optional one
+no_timer = PhaseTimer(enabled=False)
+
+
+class ProfilerWindow:
+    """
+    Capture a tf.profiler trace of the epochs in [start, stop), viewed in the Profile tab of TensorBoard
+    """
+    def __init__(self, logdir, start=None, stop=None):
+        """
+        :param logdir: Log directory of the run, the trace is written to its plugins/profile subdirectory
+        :param start: First traced epoch, nothing is traced if not given
+        :param stop: Epoch after the last traced one
+        """
+        self.logdir = logdir
+        self.start = start
+        self.stop = stop
+        self.running = False
+
+    def step(self, epoch):
+        """
+        Call at the beginning of every epoch
+        """
+        if self.start is None:
+            return
+        if not self.running and self.start <= epoch < self.stop:
+            tf.profiler.experimental.start(self.logdir)
+            self.running = True
+        elif self.running and epoch >= self.stop:
+            self.close()
+
+    def close(self):
+        if self.running:
+            tf.profiler.experimental.stop()
+            self.running = False
@@ -0,0 +1,90 @@
+import json
+import os
+import sqlite3
+
+
+class ResultsStore:
+    """
+    Append-only store of evaluation results in an SQLite database. Every trial is written as soon as it completes,
+    keyed by model, dataset, number of classes, learning rate and seed, so that interrupted evaluations can resume
+    and only the needed slices have to be loaded for plotting. Values are stored as JSON.
+    """
+    def __init__(self, path="results/results.db"):
+        """
+        :param path: Database file, created if it doesn't exist
+        :type path: str
+        """
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS results ("
+                                "model TEXT, dataset TEXT, classes INTEGER, learning_rate REAL, seed INTEGER, "
+                                "metric TEXT, value TEXT, "
+                                "PRIMARY KEY (model, dataset, classes, learning_rate, seed, metric))")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS configs ("
+                                "model TEXT, dataset TEXT, config TEXT, PRIMARY KEY (model, dataset))")
+        self.connection.commit()
+
+    def append(self, model, dataset, classes, learning_rate, seed, **metrics):
+        """
+        Store the metrics of one trial, replacing the results of the same trial if they already exist
+        :param metrics: Metric names and their JSON serializable values
+        """
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                        [(model, dataset, classes, learning_rate, seed, metric, json.dumps(value))
+                                         for metric, value in metrics.items()])
+
+    def check_config(self, model, dataset, config):
+        """
+        Store the configuration of the evaluation of a model (checkpoints, data, ...) on first use, so that its trials
+        are only resumed by evaluations with the same configuration
+        :param config: JSON serializable configuration
+        :raises ValueError: If the stored trials of the model were evaluated with another configuration
+        """
+        config = json.dumps(config, sort_keys=True)
+        row = self.connection.execute("SELECT config FROM configs WHERE model = ? AND dataset = ?",
+                                      (model, dataset)).fetchone()
+        if row is None:
+            with self.connection:
+                self.connection.execute("INSERT INTO configs VALUES (?, ?, ?)", (model, dataset, config))
+        elif row[0] != config:
+            raise ValueError(f"Results of {model} on {dataset} were stored with the configuration {row[0]}, not "
+                             f"{config}. Use another model name or results database.")
+
+    def seeds(self, model, dataset, classes, learning_rate, metric):
+        """
+        Seeds of the trials whose metric is already stored
+        :rtype: set
+        """
+        rows = self.connection.execute("SELECT seed FROM results WHERE model = ? AND dataset = ? AND classes = ? "
+                                       "AND learning_rate = ? AND metric = ?",
+                                       (model, dataset, classes, learning_rate, metric))
+        return {seed for seed, in rows}
+
+    def load(self, **keys):
+        """
+        Load the results matching the given keys, e.g. load(model="mrcl", classes=10, metric="test_accuracy")
+        :return: Results as dicts with the keys and the value, ordered by learning rate and seed
+        :rtype: list
+        """
+        columns = ["model", "dataset", "classes", "learning_rate", "seed", "metric"]
+        unknown = set(keys) - set(columns)
+        if unknown:
+            raise ValueError(f"Unknown keys {sorted(unknown)}")
+        query = "SELECT model, dataset, classes, learning_rate, seed, metric, value FROM results"
+        if keys:
+            query += " WHERE " + " AND ".join(f"{key} = ?" for key in keys)
+        rows = self.connection.execute(query + " ORDER BY learning_rate, seed", tuple(keys.values()))
+        return [dict(zip(columns, row[:-1]), value=json.loads(row[-1])) for row in rows]
+
+    def values(self, model, dataset, classes, learning_rate, metric):
+        """
+        Values of a metric over all stored trials, ordered by seed
+        :rtype: list
+        """
+        return [result["value"] for result in self.load(model=model, dataset=dataset, classes=classes,
+                                                        learning_rate=learning_rate, metric=metric)]
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,22 @@
+import time
+
+from util.profiling import PhaseTimer
+
+
+def test_phase_timer_accumulates_phases_until_written():
+    timer = PhaseTimer()
+    for _ in range(2):
+        with timer.phase("data"):
+            time.sleep(0.01)
+    with timer.phase("optimizer"):
+        pass
+    assert set(timer.times) == {"data", "optimizer"}
+    assert timer.times["data"] >= 0.02
+
+    timer.write(0)
+    assert not timer.times
+
+    disabled = PhaseTimer(enabled=False)
+    with disabled.phase("data"):
+        pass
+    assert not disabled.times
@@ -0,0 +1,35 @@
+import pytest
+
+from util.results_store import ResultsStore
+
+
+def test_results_store_appends_and_resumes(tmpdir):
+    path = str(tmpdir.join("results.db"))
+    store = ResultsStore(path)
+    store.append("mrcl", "isw", 10, 0.003, 0, loss=1.5, **{"3a": {"1": 0.5}})
+    store.append("mrcl", "isw", 10, 0.003, 1, loss=2.5)
+    store.append("mrcl", "isw", 10, 0.01, 0, loss=3.5)
+    store.close()
+
+    store = ResultsStore(path)
+    assert store.seeds("mrcl", "isw", 10, 0.003, "loss") == {0, 1}
+    assert store.seeds("mrcl", "isw", 10, 0.003, "3a") == {0}
+    assert store.values("mrcl", "isw", 10, 0.003, "loss") == [1.5, 2.5]
+    assert store.load(metric="3a")[0]["value"] == {"1": 0.5}
+
+    store.append("mrcl", "isw", 10, 0.003, 1, loss=4.5)
+    assert store.values("mrcl", "isw", 10, 0.003, "loss") == [1.5, 4.5]
+    assert [result["learning_rate"] for result in store.load(model="mrcl", metric="loss")] == [0.003, 0.003, 0.01]
+
+
+def test_results_store_refuses_to_resume_another_config(tmpdir):
+    path = str(tmpdir.join("results.db"))
+    store = ResultsStore(path)
+    store.check_config("mrcl", "isw", {"model_file_rln": "rln_a", "repetitions": 50})
+    store.close()
+
+    store = ResultsStore(path)
+    store.check_config("mrcl", "isw", {"repetitions": 50, "model_file_rln": "rln_a"})
+    store.check_config("mrcl", "omniglot", {"model_file_rln": "rln_b"})
+    with pytest.raises(ValueError):
+        store.check_config("mrcl", "isw", {"model_file_rln": "rln_b", "repetitions": 50})